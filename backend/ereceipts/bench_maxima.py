@@ -0,0 +1,64 @@
+import os
+import glob
+import time
+import email
+import argparse
+
+from parsers.maxima_parser import maxima_parser, ENGINES
+from raw_cache import RawEmailCache
+
+
+def load_receipts(path):
+    """
+    Loads Maxima receipt html from a directory of .html files or from the raw email cache.
+    """
+    html_files = glob.glob(os.path.join(path, '*.html'))
+    if html_files:
+        for html_file in sorted(html_files):
+            with open(html_file, 'r', encoding='utf-8') as f:
+                yield f.read()
+        return
+
+    for email_body in RawEmailCache(path).iter_raw():
+        email_message = email.message_from_bytes(email_body)
+        if 'maxima.ee' not in (email_message['From'] or ''):
+            continue
+        for part in email_message.walk():
+            if part.get_content_type() == 'text/html':
+                yield part.get_payload(decode=True).decode(errors='replace')
+                break
+
+
+def same_output(a, b):
+    return (
+        a['location'] == b['location']
+        and a['total'] == b['total']
+        and a['dtime'] == b['dtime']
+        and a['products'].equals(b['products'])
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Per receipt latency of the maxima_parser engines")
+    arg_parser.add_argument("path", nargs="?", default="./data/raw_emails", help="directory with .html receipts or the raw email cache")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    receipts = list(load_receipts(args.path))
+    if not receipts:
+        raise SystemExit(f"No Maxima receipts found in {args.path}")
+
+    outputs = {}
+    for engine in ENGINES:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outputs[engine] = [maxima_parser(html, engine=engine) for html in receipts]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{engine:12s} {best / len(receipts) * 1000:8.2f} ms/receipt ({len(receipts)} receipts)")
+
+    mismatches = sum(
+        not same_output(a, b) for a, b in zip(outputs['html.parser'], outputs['lxml'])
+    )
+    print(f"Outputs differ for {mismatches} of {len(receipts)} receipts")
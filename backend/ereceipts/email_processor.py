@@ -2,19 +2,62 @@ import pandas as pd
 from collections import defaultdict
 import imaplib
 import email
-from email.header import decode_header
+from email.utils import parseaddr
+from datetime import date
 import os
+import argparse
+import hashlib
+import io
 from dotenv import load_dotenv
-import re
-from bs4 import BeautifulSoup
+from sync_checkpoint import SyncCheckpoint
+from record_sink import open_sink
+from raw_cache import RawEmailCache
+from parse_cache import ParseCache
+from receipt_store import ReceiptStore
+from normalize import normalize_records
+from parallel_parse import parallel_map
+from concurrent.futures import ProcessPoolExecutor
+from imap_pool import IMAPConnectionPool
+from imap_utils import compress_uid_set, chunked, uid_fetch, decode_subject, build_search_query
+from parsers import PARSERS, get_parser_name, load_parser
 
 class EmailProcessor:
+    HEADER_BATCH_SIZE = 500
+    BODY_BATCH_SIZE = 50
+
     def __init__(self):
         load_dotenv()
         self.imap_server = os.getenv("IMAP_SERVER")
+        self.imap_port = int(os.getenv("IMAP_PORT", imaplib.IMAP4_SSL_PORT))
+        # plain IMAP is only meant for local testing, e.g. against a fake IMAP server
+        self.imap_ssl = os.getenv("IMAP_SSL", "1") != "0"
         self.email_address = os.getenv("EMAIL_ADDRESS")
         self.password = os.getenv("EMAIL_PASSWORD")
         self.imap_connection = None
+        # parallel connections used for fetching, 1 means everything runs on imap_connection
+        self.pool_size = int(os.getenv("IMAP_POOL_SIZE", 1))
+        self.pool = None
+        self.parse_workers = int(os.getenv("PARSE_WORKERS", 1))
+        self.parse_failures = []
+        # UIDs the server returned nothing for, retried on the next run like the parse failures
+        self.fetch_failures = set()
+        self.full_sync = True
+        # (folder, uidvalidity, last UID) of the finished sync, saved by save_checkpoint
+        self.sync_state = None
+        self.checkpoint = SyncCheckpoint(os.getenv("SYNC_CHECKPOINT_PATH", "./data/sync_checkpoint.json"))
+        self.raw_cache = None
+        raw_cache_dir = os.getenv("RAW_CACHE_DIR", "./data/raw_emails")
+        if raw_cache_dir:
+            raw_cache_max_mb = os.getenv("RAW_CACHE_MAX_MB")
+            self.raw_cache = RawEmailCache(
+                raw_cache_dir,
+                compress=os.getenv("RAW_CACHE_COMPRESS", "1") != "0",
+                max_bytes=int(raw_cache_max_mb) * 1024 * 1024 if raw_cache_max_mb else None
+            )
+        parse_cache_path = os.getenv("PARSE_CACHE_PATH", "./data/parse_cache.sqlite")
+        self.parse_cache = ParseCache(parse_cache_path) if parse_cache_path else None
+        receipt_db_path = os.getenv("RECEIPT_DB_PATH", "./data/receipts.sqlite")
+        self.receipt_store = ReceiptStore(receipt_db_path) if receipt_db_path else None
         self.filters = [
             {"sender": "noreply.tsekk@maxima.ee", "subject": "Sinu ostutšekk!"},
             {"sender": "noreply@rimibaltic.com", "subject": "Sinu ostutšekk"},
@@ -23,8 +66,7 @@ class EmailProcessor:
 
     def connect(self):
         try:
-            self.imap_connection = imaplib.IMAP4_SSL(self.imap_server)
-            self.imap_connection.login(self.email_address, self.password)
+            self.imap_connection = self.open_connection()
             print("Connected successfully to the IMAP server.")
         except imaplib.IMAP4.error as e:
             print(f"IMAP login failed: {e}")
@@ -33,158 +75,343 @@ class EmailProcessor:
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
 
+    def open_connection(self):
+        if self.imap_ssl:
+            connection = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+        else:
+            connection = imaplib.IMAP4(self.imap_server, self.imap_port)
+        connection.login(self.email_address, self.password)
+        return connection
+
     def disconnect(self):
         if self.imap_connection:
             self.imap_connection.logout()
 
-    def get_filtered_emails(self):
-        self.imap_connection.select("INBOX")
-        filtered_emails = defaultdict(list)
+    def get_uidvalidity(self):
+        _, data = self.imap_connection.response("UIDVALIDITY")
+        if not data or data[0] is None:
+            return None
+        return int(data[0])
 
+    def match_filter(self, email_sender, email_subject):
+        sender_address = parseaddr(email_sender or "")[1].lower()
         for filter_criteria in self.filters:
-            sender = filter_criteria["sender"]
-            subject = filter_criteria["subject"]
-            
-            _, message_numbers = self.imap_connection.search(None, f'FROM "{sender}"')
-            
-            for num in message_numbers[0].split():
-                _, msg_data = self.imap_connection.fetch(num, '(RFC822)')
-                email_body = msg_data[0][1]
-                email_message = email.message_from_bytes(email_body)
-                
-                email_subject, encoding = decode_header(email_message["Subject"])[0]
-                if isinstance(email_subject, bytes):
-                    email_subject = email_subject.decode(encoding or "utf-8")
-                
-                if email_subject == subject:
-                    email_sender = email_message["From"]
-                    email_date = email_message["Date"]
-                    
-                    content = self.get_email_content(email_message)
-                    
-                    filtered_emails[sender].append({
+            if sender_address == filter_criteria["sender"] and email_subject == filter_criteria["subject"]:
+                return filter_criteria
+        return None
+
+    def get_filtered_emails(self, folder="INBOX", full_resync=False, since=None):
+        filtered_emails = defaultdict(list)
+        for sender, email_data in self.iter_filtered_emails(folder, full_resync, since):
+            filtered_emails[sender].append(email_data)
+        return filtered_emails
+
+    def iter_filtered_emails(self, folder="INBOX", full_resync=False, since=None):
+        # select the folder right away so full_sync is known before the first email is consumed
+        self.imap_connection.select(folder)
+        uidvalidity = self.get_uidvalidity()
+        last_uid = 0 if full_resync else self.checkpoint.get_last_uid(folder, uidvalidity)
+        self.full_sync = last_uid == 0
+        if not self.full_sync:
+            print(f"Fetching emails newer than UID {last_uid} in {folder}")
+
+        return self._iter_filtered_emails(folder, uidvalidity, last_uid, since)
+
+    def _iter_filtered_emails(self, folder, uidvalidity, last_uid, since):
+        evictions = self.raw_cache.evictions if self.raw_cache is not None else 0
+        if self.pool_size > 1:
+            self.pool = IMAPConnectionPool(self.open_connection, folder, self.pool_size)
+
+        try:
+            # one search for all the filters, the server narrows down the subjects and
+            # match_filter below checks them exactly
+            query = build_search_query(self.filters, last_uid, since)
+            _, uids = self.imap_connection.uid("search", None, query)
+
+            # "n:*" always matches the newest message, even when its UID is below n
+            uids = [int(uid) for uid in uids[0].split() if int(uid) > last_uid]
+            max_uid = max([last_uid] + uids)
+
+            # emails that failed to parse on the previous run are fetched again
+            if last_uid:
+                uids = sorted(set(uids) | set(self.checkpoint.get_failed_uids(folder, uidvalidity)))
+
+            # phase one: fetch only the headers and route each email to its filter
+            # SEARCH SUBJECT is a substring match, so the exact subject is still checked here
+            matched_headers = {}
+            for uid, header in self.fetch_headers(uids):
+                header_message = email.message_from_bytes(header)
+                email_subject = decode_subject(header_message["Subject"])
+                filter_criteria = self.match_filter(header_message["From"], email_subject)
+                if filter_criteria:
+                    matched_headers[uid] = (filter_criteria["sender"], {
+                        "uid": uid,
+                        "message_id": header_message["Message-ID"],
                         "subject": email_subject,
-                        "sender": email_sender,
-                        "date": email_date,
-                        "content": content
+                        "sender": header_message["From"],
+                        "date": header_message["Date"]
                     })
 
-        return filtered_emails
+            # phase two: read already downloaded emails from the local cache,
+            # then download full messages for the remaining matched emails
+            to_download = []
+            for uid in sorted(matched_headers):
+                sender, headers = matched_headers[uid]
+                email_body = None
+                if self.raw_cache is not None and headers["message_id"]:
+                    email_body = self.raw_cache.get(RawEmailCache.make_key(headers["message_id"]))
+                if email_body is None:
+                    to_download.append(uid)
+                else:
+                    yield sender, self.make_email_data(email_body, headers)
+
+            for uid, email_body in self.fetch_messages(to_download):
+                sender, headers = matched_headers[uid]
+                if self.raw_cache is not None:
+                    self.raw_cache.put(RawEmailCache.make_key(headers["message_id"], email_body), email_body)
+                yield sender, self.make_email_data(email_body, headers)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+        # only reached when every email has been consumed
+        self.sync_state = (folder, uidvalidity, max_uid)
+
+        # a full sync without evictions or missing emails put the whole history back in the cache
+        if (self.raw_cache is not None and self.full_sync and since is None and not self.fetch_failures
+                and self.raw_cache.evictions == evictions and self.raw_cache.has_evicted()):
+            self.raw_cache.clear_evicted()
+            print(f"The raw email cache in {self.raw_cache.root} holds every email again, --offline can be used")
+
+    def save_checkpoint(self):
+        """
+        Saves the checkpoint of the finished sync. The emails whose receipts failed to parse or
+        that the server didn't return are kept in it, so the next incremental run fetches them
+        again instead of skipping them.
+        """
+        if self.sync_state is None:
+            return
+        failed_uids = [failure["uid"] for failure in self.parse_failures if failure.get("uid") is not None]
+        failed_uids += self.fetch_failures
+        self.checkpoint.update(*self.sync_state, failed_uids=failed_uids)
+        self.checkpoint.save()
+
+    def iter_cached_emails(self):
+        # parse straight from the local raw email cache, without connecting to the server
+        for email_body in self.raw_cache.iter_raw():
+            email_message = email.message_from_bytes(email_body)
+            email_subject = decode_subject(email_message["Subject"])
+            filter_criteria = self.match_filter(email_message["From"], email_subject)
+            if filter_criteria:
+                yield filter_criteria["sender"], self.make_email_data(email_body, {
+                    "message_id": email_message["Message-ID"],
+                    "subject": email_subject,
+                    "sender": email_message["From"],
+                    "date": email_message["Date"]
+                }, email_message)
+
+    def make_email_data(self, email_body, headers, email_message=None):
+        if email_message is None:
+            email_message = email.message_from_bytes(email_body)
+        return {
+            **headers,
+            "content_hash": hashlib.sha256(email_body).hexdigest(),
+            "content": self.get_email_content(email_message),
+            "attachments": self.get_attachments(email_message)
+        }
+
+    def fetch_batches(self, uids, batch_size, query):
+        uid_sets = [compress_uid_set(batch) for batch in chunked(uids, batch_size)]
+        if self.pool is not None:
+            responses = self.pool.fetch(uid_sets, query)
+        else:
+            responses = (pair for uid_set in uid_sets for pair in uid_fetch(self.imap_connection, uid_set, query))
+
+        returned = set()
+        for uid, payload in responses:
+            returned.add(uid)
+            yield uid, payload
+        # e.g. a message the server could not read or that was expunged after the search
+        missing = set(uids) - returned
+        if missing:
+            print(f"The server returned nothing for {len(missing)} UIDs, they are retried on the next run")
+            self.fetch_failures |= missing
+
+    def fetch_headers(self, uids):
+        yield from self.fetch_batches(uids, self.HEADER_BATCH_SIZE, "(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)])")
+
+    def fetch_messages(self, uids):
+        yield from self.fetch_batches(uids, self.BODY_BATCH_SIZE, "(UID RFC822)")
 
     def get_email_content(self, email_message):
         if email_message.is_multipart():
+            # prefer the html part, the parsers work on the html receipts
+            content = None
             for part in email_message.walk():
-                print('content type', part.get_content_type())
-                if part.get_content_type() in ["text/plain", "text/html"]:
+                if part.get_content_type() == "text/html":
                     return part.get_payload(decode=True).decode(errors='replace')
+                if part.get_content_type() == "text/plain" and content is None:
+                    content = part.get_payload(decode=True).decode(errors='replace')
+            return content
         else:
             return email_message.get_payload(decode=True).decode(errors='replace')
 
+    def get_attachments(self, email_message):
+        # same format as the attachments of imbox messages
+        attachments = []
+        for part in email_message.walk():
+            if part.get_filename() or part.get_content_disposition() == "attachment":
+                payload = part.get_payload(decode=True)
+                if payload is not None:
+                    attachments.append({
+                        "content-type": part.get_content_type(),
+                        "filename": part.get_filename(),
+                        "content": io.BytesIO(payload)
+                    })
+        return attachments
+
     def parse_emails(self, filtered_emails):
-        parsed_data = []
-        for sender, emails in filtered_emails.items():
-            for email_data in emails:
-                if "maxima.ee" in sender:
-                    parsed_data.append(self.parse_maxima_email(email_data))
-                elif "rimibaltic.com" in sender:
-                    parsed_data.append(self.parse_rimi_email(email_data))
-                elif "bolt.eu" in sender:
-                    parsed_data.append(self.parse_bolt_email(email_data))
-        return parsed_data
-
-    def parse_maxima_email(self, email_data):
-        soup = BeautifulSoup(email_data['content'], 'html.parser')
-        items = []
-        items_table = soup.find('div', id='linestable')
-        for row in items_table.find_all('tr'):
-            cells = row.find_all('td')
-            if len(cells) == 3:
-                item = {
-                    "name": cells[0].text.strip(),
-                    "quantity": cells[1].text.strip(),
-                    "price": cells[2].text.strip()
-                }
-                items.append(item)
-        
-        total_price = soup.find('tr', class_='totalPrice')
-        total = total_price.find_all('td')[1].text.strip() if total_price else None
+        emails = ((sender, email_data) for sender, sender_emails in filtered_emails.items() for email_data in sender_emails)
+        return list(self.iter_parsed_emails(emails))
 
-        payment_method = "Card" if soup.find(string=re.compile("Makstud Pangakaardiga")) else None
+    def iter_parsed_emails(self, emails, workers=None, chunksize=8):
+        """
+        Yields parsed receipts in the order of emails. Receipts that are not in the parse cache
+        are parsed in a process pool of `workers` processes (parse_workers by default),
+        a receipt that fails to parse is reported and skipped.
+        """
+        workers = workers or self.parse_workers
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            for window in chunked(emails, workers * chunksize * 4):
+                tasks = []
+                for sender, email_data in window:
+                    parser_name = get_parser_name(sender)
+                    if parser_name is not None:
+                        tasks.append((parser_name, email_data, self.get_cached_parse(parser_name, email_data)))
 
-        return {
-            "date": email_data['date'],
-            "store": "Maxima",
-            "address": "Placeholder", # TODO implement
-            "items": items,
-            "total": total,
-            "payment_method": payment_method
-        }
+                to_parse = [(parser_name, email_data) for parser_name, email_data, cached in tasks if cached is None]
+                results = parallel_map(run_parser, to_parse, workers=1, chunksize=chunksize, executor=executor)
 
-    def parse_rimi_email(self, email_data):
-        soup = BeautifulSoup(email_data['content'], 'html.parser')
-        # Assuming similar structure as Maxima
-        items = []
-        return {
-            "date": email_data['date'],
-            "store": "Rimi",
-            "address": None,
-            "items": items, # Should be filled with actual parsing
-            "total": None,  # Same here
-            "payment_method": None
-        }
+                for parser_name, email_data, cached in tasks:
+                    parsed = cached
+                    if parsed is None:
+                        parsed, error = next(results)
+                        if error is not None:
+                            print(f"Failed to parse {parser_name} receipt {email_data.get('message_id')} from {email_data.get('date')}: {error}")
+                            self.parse_failures.append({
+                                "parser": parser_name,
+                                "uid": email_data.get("uid"),
+                                "message_id": email_data.get("message_id"),
+                                "error": error
+                            })
+                            continue
+                        self.put_cached_parse(parser_name, email_data, parsed)
 
-    def parse_bolt_email(self, email_data):
-        soup = BeautifulSoup(email_data['content'], 'html.parser')
-        items = []
-        items_table = soup.find('table', class_='header')
-        for row in items_table.find_all('tr'):
-            item_name = row.find('span', style="color: #2f313f; font-size: 16px; line-height: 24px;")
-            if item_name:
-                item = {
-                    "name": item_name.text.strip(),
-                    "quantity": row.find('span', style="display: inline-block; color: #2f313f; font-size: 16px; line-height: 24px;").text.strip(),
-                    "price": row.find('p', style="display: inline-block; color: #2f313f; font-size: 16px; line-height: 24px;").text.strip()
-                }
-                items.append(item)
+                    # an email with several receipts, e.g. several rimi pdf attachments, gives a list
+                    receipts = parsed if isinstance(parsed, list) else [parsed]
+                    message_id = email_data.get("message_id") or email_data.get("content_hash")
+                    for receipt_index, receipt in enumerate(receipts):
+                        yield dict(receipt, message_id=message_id, receipt_index=receipt_index)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-        total = soup.find('p', string="Total charged:").find_next('p').text.strip()
-        payment_method = "Mastercard" if soup.find('img', src=re.compile("mc-2x.png")) else None
+    def get_cached_parse(self, parser_name, email_data):
+        if self.parse_cache is None or not email_data.get("content_hash"):
+            return None
+        return self.parse_cache.get(email_data["content_hash"], parser_name, PARSERS[parser_name].version)
 
-        return {
-            "date": email_data['date'],
-            "store": soup.find(string="From").find_next('span').text.strip(),
-            "address": soup.find(string="From").find_next('a', class_='address-title').text.strip(),
-            "items": items,
-            "total": total,
-            "payment_method": payment_method
-        }
+    def put_cached_parse(self, parser_name, email_data, parsed):
+        if self.parse_cache is None or not email_data.get("content_hash"):
+            return
+        self.parse_cache.put(email_data["content_hash"], parser_name, PARSERS[parser_name].version, parsed)
 
-    def to_dataframe(self, parsed_emails):
-        records = []
+    def iter_records(self, parsed_emails):
         for email in parsed_emails:
             for item in email['items']:
-                record = {
+                yield {
                     "date": email.get('date'),
                     "store": email.get('store'),
                     "address": email.get('address'),
                     "item_name": item.get('name'),
                     "item_quantity": item.get('quantity'),
+                    "item_quantity_unit": item.get('quantity_unit'),
                     "item_price": item.get('price'),
                     "total": email.get('total'),
                     "payment_method": email.get('payment_method')
                 }
-                records.append(record)
 
-        df = pd.DataFrame(records)
+    def to_dataframe(self, parsed_emails, typed=False):
+        df = pd.DataFrame(list(self.iter_records(parsed_emails)))
+        if typed:
+            df = normalize_records(df)
         return df
 
+def run_parser(task):
+    # module level so it can be sent to the parsing worker processes
+    parser_name, email_data = task
+    return load_parser(parser_name)(email_data)
+
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--full-resync", action="store_true", help="ignore the sync checkpoint and fetch all emails, "
+                            "this also makes an evicted raw email cache usable for --offline again")
+    arg_parser.add_argument("--since", type=date.fromisoformat, help="only fetch emails received on or after this date (YYYY-MM-DD)")
+    arg_parser.add_argument("--offline", action="store_true", help="parse all emails from the local raw email cache, "
+                            "refused after RAW_CACHE_MAX_MB evicted emails until a --full-resync without --since")
+    arg_parser.add_argument("--output", help="output .csv file or .parquet dataset directory (output.csv, output.parquet with --typed)")
+    arg_parser.add_argument("--typed", action="store_true", help="write a typed parquet dataset partitioned by month to --output")
+    arg_parser.add_argument("--db", help="sqlite database the receipts are stored in (RECEIPT_DB_PATH by default)")
+    arg_parser.add_argument("--pool-size", type=int, help="number of parallel IMAP connections used for fetching")
+    arg_parser.add_argument("--parse-workers", type=int, help="number of processes used for parsing receipts")
+    args = arg_parser.parse_args()
+    if args.output is None:
+        args.output = "output.parquet" if args.typed else "output.csv"
+
     processor = EmailProcessor()
-    processor.connect()
-    filtered_emails = processor.get_filtered_emails()
-    parsed_emails = processor.parse_emails(filtered_emails)
-    df = processor.to_dataframe(parsed_emails)
-    processor.disconnect()
-
-    print(df)
-    df.to_csv('output.csv')
+    if args.pool_size:
+        processor.pool_size = args.pool_size
+    if args.parse_workers:
+        processor.parse_workers = args.parse_workers
+    if args.offline:
+        # offline runs rewrite the output from the cache, which must still hold every email
+        if processor.raw_cache is None:
+            raise SystemExit("--offline needs the raw email cache, RAW_CACHE_DIR is empty")
+        if processor.raw_cache.has_evicted():
+            raise SystemExit(
+                f"The raw email cache in {processor.raw_cache.root} had emails evicted (RAW_CACHE_MAX_MB), "
+                "so --offline can't rebuild the full history. Run a --full-resync (without --since) instead."
+            )
+        emails = processor.iter_cached_emails()
+        # the cache holds the full history, so the output is always rewritten
+        processor.full_sync = True
+    else:
+        processor.connect()
+        emails = processor.iter_filtered_emails(full_resync=args.full_resync, since=args.since)
+    if args.db:
+        if processor.receipt_store is not None:
+            processor.receipt_store.close()
+        processor.receipt_store = ReceiptStore(args.db)
+    receipts = processor.iter_parsed_emails(emails)
+    if processor.receipt_store is not None:
+        receipts = processor.receipt_store.iter_upsert(receipts)
+    records = processor.iter_records(receipts)
+
+    # incremental runs only fetch new receipts, so append them instead of rewriting the history
+    with open_sink(args.output, append=not processor.full_sync, typed=args.typed) as sink:
+        sink.write(records)
+    print(f"Wrote {sink.count} records to {args.output}")
+    if processor.parse_failures:
+        print(f"{len(processor.parse_failures)} receipts failed to parse")
+    if processor.parse_cache is not None:
+        print(f"Parse cache: {processor.parse_cache.hits} hits, {processor.parse_cache.misses} misses")
+        processor.parse_cache.close()
+    if processor.receipt_store is not None:
+        print(f"Stored receipts in {processor.receipt_store.path}")
+        processor.receipt_store.close()
+
+    if not args.offline:
+        processor.disconnect()
+        processor.save_checkpoint()
@@ -0,0 +1,107 @@
+import imaplib
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from imap_utils import uid_fetch
+
+
+class IMAPConnectionPool:
+    """
+    Bounded pool of authenticated IMAP connections with the same folder selected,
+    used to run UID FETCH commands in parallel threads.
+    """
+    def __init__(self, open_connection, folder, size=4, retries=2):
+        self.open_connection = open_connection
+        self.folder = folder
+        self.size = size
+        self.retries = retries
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _create(self):
+        connection = self.open_connection()
+        connection.select(self.folder)
+        return connection
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+        if not can_create:
+            return self.idle.get()
+
+        try:
+            return self._create()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def _discard(self, connection):
+        with self.lock:
+            self.created -= 1
+        try:
+            connection.shutdown()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        except (imaplib.IMAP4.abort, OSError):
+            # the connection dropped, a new one is opened on the next acquire
+            self._discard(connection)
+            raise
+        except Exception:
+            self.idle.put(connection)
+            raise
+        else:
+            self.idle.put(connection)
+
+    def fetch_batch(self, uid_set, query):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as connection:
+                    return uid_fetch(connection, uid_set, query)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if attempt == self.retries:
+                    raise
+                print(f"IMAP connection dropped ({e}), reconnecting")
+
+    def fetch(self, uid_sets, query):
+        """
+        Fetches the UID sets in parallel and yields (uid, payload) pairs in the order of uid_sets.
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            for uid_set in uid_sets:
+                pending.append(executor.submit(self.fetch_batch, uid_set, query))
+                # keep a bounded number of batches in flight
+                if len(pending) >= self.size * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def close(self):
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                connection.logout()
+            except Exception:
+                pass
+        self.created = 0
@@ -0,0 +1,133 @@
+import re
+import imaplib
+from itertools import islice
+from email.header import decode_header
+
+UID_PATTERN = re.compile(rb'UID (\d+)')
+
+
+def compress_uid_set(uids):
+    """
+    Turns a list of UIDs into a compact IMAP sequence set, e.g. [1, 2, 3, 7] -> "1:3,7".
+    """
+    uids = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    start = prev = None
+    for uid in uids:
+        if start is None:
+            start = prev = uid
+        elif uid == prev + 1:
+            prev = uid
+        else:
+            ranges.append((start, prev))
+            start = prev = uid
+    if start is not None:
+        ranges.append((start, prev))
+
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def chunked(items, size):
+    # lazy, so it can also be used on generators without loading them into memory
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_fetch_response(data):
+    """
+    Yields (uid, payload) pairs from the response of a UID FETCH command.
+    """
+    pending = None
+    for part in data:
+        if isinstance(part, tuple):
+            if pending is not None and pending[0] is not None:
+                yield pending[0], pending[1]
+            match = UID_PATTERN.search(part[0])
+            pending = [int(match.group(1)) if match else None, part[1]]
+        elif pending is not None and isinstance(part, bytes):
+            # some servers send the UID after the literal, e.g. b' UID 42)'
+            if pending[0] is None:
+                match = UID_PATTERN.search(part)
+                pending[0] = int(match.group(1)) if match else None
+            if pending[0] is not None:
+                yield pending[0], pending[1]
+            pending = None
+
+    if pending is not None and pending[0] is not None:
+        yield pending[0], pending[1]
+
+
+def uid_fetch(connection, uid_set, query):
+    """
+    Runs a UID FETCH and returns its (uid, payload) pairs, raises imaplib.IMAP4.error when the
+    server answers NO. A BAD answer already raises inside imaplib.
+    """
+    typ, data = connection.uid("fetch", uid_set, query)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH {uid_set} failed: {typ} {data!r}")
+    return list(parse_fetch_response(data))
+
+
+def decode_subject(raw_subject):
+    if raw_subject is None:
+        return None
+    subject, encoding = decode_header(raw_subject)[0]
+    if isinstance(subject, bytes):
+        subject = subject.decode(encoding or "utf-8")
+    return subject
+
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def format_imap_date(date):
+    # IMAP dates are always in english, so don't rely on the locale dependent strftime('%b')
+    return f'{date.day}-{MONTHS[date.month - 1]}-{date.year}'
+
+
+def quote(value):
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+NON_ASCII_PATTERN = re.compile(r'[^\x20-\x7e]+')
+
+
+def ascii_search_term(value, min_length=3):
+    """
+    Longest ascii only piece of value, e.g. "Sinu ostut" for "Sinu ostutšekk", None when
+    it is shorter than min_length. Quoted strings in IMAP commands may only contain 7 bit
+    characters and strict servers reject anything else, so non-ascii subjects are searched
+    by a part and matched exactly by the client.
+    """
+    term = max(NON_ASCII_PATTERN.split(value), key=len).strip()
+    return term if len(term) >= min_length else None
+
+
+def build_search_query(filters, last_uid=0, since=None):
+    """
+    Builds a single ascii SEARCH query that matches any of the (sender, subject) filters:
+    OR (FROM a SUBJECT x) OR (FROM b SUBJECT y) (FROM c SUBJECT z)
+    The subjects are narrowed to their ascii part, see ascii_search_term.
+    """
+    criteria = []
+    for f in filters:
+        subject = ascii_search_term(f["subject"])
+        if subject is None:
+            criteria.append(f'(FROM {quote(f["sender"])})')
+        else:
+            criteria.append(f'(FROM {quote(f["sender"])} SUBJECT {quote(subject)})')
+    query = criteria[-1]
+    for criterion in reversed(criteria[:-1]):
+        query = f'OR {criterion} {query}'
+
+    parts = [f'UID {last_uid + 1}:*']
+    if since is not None:
+        parts.append(f'SINCE {format_imap_date(since)}')
+    parts.append(query)
+
+    return ' '.join(parts)
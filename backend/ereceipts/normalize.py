@@ -0,0 +1,61 @@
+import re
+import math
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+import pandas as pd
+
+AMOUNT_PATTERN = re.compile(r'-?\d+(?:[.,]\d+)?')
+
+
+def parse_amount(value):
+    """
+    Parses receipt amounts like "1,29 €", "× 2" or "0.5kg" into a float, None when there is no number.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return None if isinstance(value, float) and math.isnan(value) else float(value)
+    match = AMOUNT_PATTERN.search(str(value).replace('\xa0', ' '))
+    if match is None:
+        return None
+    return float(match.group().replace(',', '.'))
+
+
+def parse_date(value):
+    """
+    Parses an RFC 2822 Date header into a timezone aware UTC datetime, None when it can't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).astimezone(timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+AMOUNT_COLUMNS = ['item_quantity', 'item_price', 'total']
+CATEGORY_COLUMNS = ['store', 'address', 'item_quantity_unit', 'payment_method']
+
+
+def map_unique(series, func):
+    # receipt level values repeat on every item row, so each distinct value is parsed once
+    values = series.dropna().unique()
+    return series.map(dict(zip(values, map(func, values))))
+
+
+def normalize_records(df):
+    """
+    Converts a DataFrame of EmailProcessor records to typed columns: float amounts,
+    a UTC datetime64 date, a YYYY-MM month and categorical store, address, item_quantity_unit and payment_method.
+    """
+    df = df.copy()
+    for column in AMOUNT_COLUMNS:
+        if column in df:
+            df[column] = map_unique(df[column], parse_amount).astype('float64')
+    if 'date' in df:
+        df['date'] = pd.to_datetime(map_unique(df['date'], parse_date), utc=True)
+        df['month'] = df['date'].dt.strftime('%Y-%m').fillna('unknown')
+    for column in CATEGORY_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype('category')
+    return df
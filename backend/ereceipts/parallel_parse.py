@@ -0,0 +1,41 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from imap_utils import chunked
+
+
+def safe_call(func, item):
+    """
+    Runs func(item) and returns (result, None), or (None, error) when it raises,
+    so one broken receipt doesn't take down the whole batch.
+    """
+    try:
+        return func(item), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+
+def parallel_map(func, items, workers=None, chunksize=8, executor=None):
+    """
+    Yields (result, error) for every item, in the same order as items.
+    func has to be a picklable module level function, e.g. maxima_parser.
+    Without an executor, a process pool of `workers` processes is created and items are
+    dispatched in windows, so a generator of items is never loaded into memory at once.
+    With workers=1 everything runs in the current process.
+    """
+    call = partial(safe_call, func)
+    if executor is not None:
+        yield from executor.map(call, items, chunksize=chunksize)
+        return
+
+    if workers == 1:
+        for item in items:
+            yield call(item)
+        return
+
+    window = (workers or os.cpu_count() or 1) * chunksize * 4
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in chunked(items, window):
+            yield from executor.map(call, batch, chunksize=chunksize)
@@ -0,0 +1,96 @@
+import os
+import json
+import sqlite3
+import argparse
+
+
+class ParseCache:
+    """
+    Persistent cache of parsed receipts keyed by (raw content hash, parser name, parser version),
+    so only new emails or emails whose parser changed are parsed again.
+    """
+    COMMIT_EVERY = 100
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS parsed_receipts (
+                content_hash TEXT NOT NULL,
+                parser TEXT NOT NULL,
+                parser_version TEXT NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (content_hash, parser, parser_version)
+            )
+        """)
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.pending_writes = 0
+
+    def get(self, content_hash, parser, parser_version):
+        row = self.connection.execute(
+            "SELECT result FROM parsed_receipts WHERE content_hash = ? AND parser = ? AND parser_version = ?",
+            (content_hash, parser, str(parser_version))
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, content_hash, parser, parser_version, result):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO parsed_receipts VALUES (?, ?, ?, ?)",
+            (content_hash, parser, str(parser_version), json.dumps(result))
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def invalidate(self, parser, parser_version=None):
+        if parser_version is None:
+            cursor = self.connection.execute("DELETE FROM parsed_receipts WHERE parser = ?", (parser,))
+        else:
+            cursor = self.connection.execute(
+                "DELETE FROM parsed_receipts WHERE parser = ? AND parser_version = ?",
+                (parser, str(parser_version))
+            )
+        self.commit()
+        return cursor.rowcount
+
+    def stats(self):
+        return self.connection.execute(
+            "SELECT parser, parser_version, COUNT(*) FROM parsed_receipts GROUP BY parser, parser_version ORDER BY parser, parser_version"
+        ).fetchall()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Inspect or invalidate the parsed receipt cache")
+    arg_parser.add_argument("--path", default=os.getenv("PARSE_CACHE_PATH", "./data/parse_cache.sqlite"))
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="number of cached receipts per parser and version")
+    invalidate_parser = subparsers.add_parser("invalidate", help="drop the cached results of one parser")
+    invalidate_parser.add_argument("parser", help="parser name, e.g. maxima")
+    invalidate_parser.add_argument("--version", help="only drop the results of this parser version")
+    args = arg_parser.parse_args()
+
+    cache = ParseCache(args.path)
+    if args.command == "stats":
+        for parser, parser_version, count in cache.stats():
+            print(f"{parser} v{parser_version}: {count}")
+    elif args.command == "invalidate":
+        deleted = cache.invalidate(args.parser, args.version)
+        print(f"Removed {deleted} cached results of the {args.parser} parser")
+    cache.close()
@@ -0,0 +1,40 @@
+import importlib
+from collections import namedtuple
+from email.utils import parseaddr
+
+# module is imported only when the first receipt of that store is parsed,
+# so e.g. the OCR dependencies of the rimi parser are not loaded for html only runs
+ParserSpec = namedtuple('ParserSpec', ['name', 'module', 'function', 'version'])
+
+PARSERS = {}
+DOMAINS = {}
+_loaded_parsers = {}
+
+def register_parser(name, domains, module, function, version=1):
+    """
+    Registers a parser function for the given sender domains. Bump the version
+    when the parser output changes, so its cached results get parsed again.
+    """
+    PARSERS[name] = ParserSpec(name, module, function, version)
+    for domain in domains:
+        DOMAINS[domain.lower()] = name
+
+def get_parser_name(sender):
+    # exact domain first, then its parent domains, e.g. mail.maxima.ee -> maxima.ee
+    domain = parseaddr(sender or '')[1].lower().rpartition('@')[2]
+    while domain:
+        if domain in DOMAINS:
+            return DOMAINS[domain]
+        domain = domain.partition('.')[2]
+    return None
+
+def load_parser(name):
+    if name not in _loaded_parsers:
+        spec = PARSERS[name]
+        module = importlib.import_module(spec.module, __name__)
+        _loaded_parsers[name] = getattr(module, spec.function)
+    return _loaded_parsers[name]
+
+register_parser('maxima', ['maxima.ee'], '.maxima_parser', 'parse_maxima_email', version=4)
+register_parser('rimi', ['rimibaltic.com'], '.rimi_parser', 'parse_rimi_email', version=3)
+register_parser('bolt', ['bolt.eu'], '.bolt_parser', 'parse_bolt_email', version=1)
@@ -0,0 +1,28 @@
+import re
+from bs4 import BeautifulSoup
+
+def parse_bolt_email(email_data):
+    soup = BeautifulSoup(email_data['content'], 'html.parser')
+    items = []
+    items_table = soup.find('table', class_='header')
+    for row in items_table.find_all('tr'):
+        item_name = row.find('span', style="color: #2f313f; font-size: 16px; line-height: 24px;")
+        if item_name:
+            item = {
+                "name": item_name.text.strip(),
+                "quantity": row.find('span', style="display: inline-block; color: #2f313f; font-size: 16px; line-height: 24px;").text.strip(),
+                "price": row.find('p', style="display: inline-block; color: #2f313f; font-size: 16px; line-height: 24px;").text.strip()
+            }
+            items.append(item)
+
+    total = soup.find('p', string="Total charged:").find_next('p').text.strip()
+    payment_method = "Mastercard" if soup.find('img', src=re.compile("mc-2x.png")) else None
+
+    return {
+        "date": email_data['date'],
+        "store": soup.find(string="From").find_next('span').text.strip(),
+        "address": soup.find(string="From").find_next('a', class_='address-title').text.strip(),
+        "items": items,
+        "total": total,
+        "payment_method": payment_method
+    }
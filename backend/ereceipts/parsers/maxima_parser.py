@@ -1,31 +1,197 @@
+import importlib.util
 from bs4 import BeautifulSoup
 import pandas as pd
 import pandas as pd
-import difflib
+import re
+from bisect import bisect_left
+from collections import defaultdict
 
-def maxima_parser(html_content, verbose = False):
+def normalize_name(name):
+    name = re.sub(r'[^\w\s]', ' ', name.lower())
+    return ' '.join(name.split())
+
+def ngrams(text, n=3):
+    text = f' {text} '
+    return {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+
+class ProductMatcher:
+    """
+    Matches discount names to product names. Tries an exact lookup, a normalized lookup
+    and a normalized prefix lookup first, and only falls back to fuzzy matching
+    over a trigram index. match() returns (product name, confidence).
+    """
+    def __init__(self, names, cutoff=0.3, min_prefix=4):
+        self.names = list(names)
+        self.cutoff = cutoff
+        self.min_prefix = min_prefix
+
+        # first occurrence wins, so ties always resolve to the earliest product on the receipt
+        self.exact = {}
+        self.normalized = {}
+        self.ngram_index = defaultdict(list)
+        self.ngram_counts = []
+        for i, name in enumerate(self.names):
+            self.exact.setdefault(name, i)
+            normalized = normalize_name(name)
+            self.normalized.setdefault(normalized, i)
+            grams = ngrams(normalized)
+            self.ngram_counts.append(len(grams))
+            for gram in grams:
+                self.ngram_index[gram].append(i)
+        self.sorted_normalized = sorted(self.normalized)
+
+    def match(self, name):
+        if name in self.exact:
+            return name, 1.0
+
+        normalized = normalize_name(name)
+        if normalized in self.normalized:
+            return self.names[self.normalized[normalized]], 0.95
+
+        prefix_match = self.match_prefix(normalized)
+        if prefix_match is not None:
+            return prefix_match
+
+        return self.match_fuzzy(normalized)
+
+    def match_prefix(self, normalized):
+        if len(normalized) < self.min_prefix:
+            return None
+
+        candidates = []
+        # product names that start with the discount name, e.g. a truncated discount name
+        start = bisect_left(self.sorted_normalized, normalized)
+        for product in self.sorted_normalized[start:]:
+            if not product.startswith(normalized):
+                break
+            candidates.append(self.normalized[product])
+        # product names the discount name starts with
+        for end in range(len(normalized) - 1, self.min_prefix - 1, -1):
+            if normalized[:end] in self.normalized:
+                candidates.append(self.normalized[normalized[:end]])
+
+        if not candidates:
+            return None
+
+        # the candidate with the largest overlap wins, ties go to the earliest product
+        def overlap(i):
+            product = normalize_name(self.names[i])
+            return min(len(product), len(normalized)) / max(len(product), len(normalized))
+
+        i = min(candidates, key=lambda i: (-overlap(i), i))
+        return self.names[i], round(0.9 * overlap(i), 3)
+
+    def match_fuzzy(self, normalized):
+        grams = ngrams(normalized)
+        shared = defaultdict(int)
+        for gram in grams:
+            for i in self.ngram_index.get(gram, ()):
+                shared[i] += 1
+        if not shared:
+            return None, 0.0
+
+        # dice coefficient of the trigram sets, ties go to the earliest product
+        scores = {i: 2 * count / (len(grams) + self.ngram_counts[i]) for i, count in shared.items()}
+        i = min(scores, key=lambda i: (-scores[i], i))
+        if scores[i] < self.cutoff:
+            return None, 0.0
+        return self.names[i], round(0.8 * scores[i], 3)
+
+def extract_html_parser(html_content):
+    """
+    Extracts the raw receipt texts with BeautifulSoup and the pure python html.parser.
+    """
     soup = BeautifulSoup(html_content, 'html.parser')
 
-    # General INFO
     receipt_table = soup.find_all("table", {"class": "receipt_table"})[0]
     store_info = receipt_table.find_all('tr')[4].text.strip()
-    total_price = float(soup.find('tr', {'class': 'totalPrice'}).find_all('td')[1].text.strip().replace('€', '').replace(',', '.'))
-    location = store_info.split('\n')[1].strip()
+    total_price = soup.find('tr', {'class': 'totalPrice'}).find_all('td')[1].text.strip()
 
     dtime_info = soup.find_all("div", {'id':'Footer'})[0].find_all("tr")[-1] # dtime in footer
-    dtime_info = dtime_info.find_all('td')[-1].text.strip()         
+    dtime_info = dtime_info.find_all('td')[-1].text.strip()
+
+    # cells of every row in the document
+    rows = [[cell.text.strip() for cell in line.find_all('td')] for line in soup.find_all('tr')]
 
-    # Product INFO
+    # rows of the discount section in the payments table
     payments_table = soup.find('div', {'id':'payments'})
+    totalDiscounts = payments_table.find('tr', {'id':'totalDiscounts'})
+    ids_to_filter = ['aitahCard', 'receivedMaximaMoney', 'MaximaMoneyBalance']
+    discount_rows = []
+    start_collecting = False
+    for tr in payments_table.find_all('tr'):
+        if tr == totalDiscounts:
+            start_collecting = True
+            continue
+        if start_collecting:
+            if tr.attrs.get('id') not in ids_to_filter:
+                discount_rows.append([cell.text.strip() for cell in tr.find_all('td')])
+
+    return store_info, total_price, dtime_info, rows, discount_rows
+
+def extract_lxml(html_content):
+    """
+    Same as extract_html_parser, but the tree is built by lxml and queried with XPath,
+    which is several times faster than building the BeautifulSoup tree. rows only holds
+    the rows maxima_parser uses, so its output is the same for both engines.
+    """
+    import lxml.html
+
+    def has_class(name):
+        return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+    def cell_texts(tr):
+        return [cell.text_content().strip() for cell in tr.iter('td')]
+
+    # lxml refuses str input with an XML encoding declaration, so it gets the utf-8 bytes
+    # and is told their encoding, which also overrides any meta charset
+    parser = lxml.html.HTMLParser(encoding='utf-8')
+    root = lxml.html.document_fromstring(html_content.encode('utf-8'), parser=parser)
+
+    receipt_table = root.xpath(f"//table[{has_class('receipt_table')}]")[0]
+    store_info = receipt_table.xpath(".//tr")[4].text_content().strip()
+    total_price = root.xpath(f"//tr[{has_class('totalPrice')}]")[0].xpath(".//td")[1].text_content().strip()
+
+    dtime_info = root.xpath("//div[@id='Footer']")[0].xpath(".//tr")[-1] # dtime in footer
+    dtime_info = dtime_info.xpath(".//td")[-1].text_content().strip()
+
+    # only the rows maxima_parser reads, product rows with three cells and their discount rows,
+    # so the cell texts of the rest of the document are never built
+    item_rows = root.xpath("//tr[count(.//td) = 3 or (count(.//td) = 2 and contains((.//td)[1], 'Discount'))]")
+    rows = [cell_texts(tr) for tr in item_rows]
+
+    payments_table = root.xpath("//div[@id='payments']")[0]
+    ids_to_filter = ['aitahCard', 'receivedMaximaMoney', 'MaximaMoneyBalance']
+    discount_rows = []
+    start_collecting = False
+    for tr in payments_table.iter('tr'):
+        if not start_collecting and tr.get('id') == 'totalDiscounts':
+            start_collecting = True
+            continue
+        if start_collecting:
+            if tr.get('id') not in ids_to_filter:
+                discount_rows.append(cell_texts(tr))
+
+    return store_info, total_price, dtime_info, rows, discount_rows
+
+ENGINES = {
+    'html.parser': extract_html_parser,
+    'lxml': extract_lxml,
+}
+
+def maxima_parser(html_content, verbose = False, engine = 'html.parser'):
+    store_info, total_price, dtime_info, rows, discount_rows = ENGINES[engine](html_content)
+
+    # General INFO
+    total_price = float(total_price.replace('€', '').replace(',', '.'))
+    location = store_info.split('\n')[1].strip()
 
     # product name, quantity, price, and price after discount
     products = []
-    lines = soup.find_all('tr')
-    for line in lines:
-        cells = line.find_all('td')
+    for cells in rows:
         if len(cells) == 3:
-            product_name = cells[0].text.strip()
-            quantity_and_price = cells[1].text.strip().split(' × ')
+            product_name = cells[0]
+            quantity_and_price = cells[1].split(' × ')
             quantity, quantity_unit = 1, 'pc'
             if len(quantity_and_price)>1:
                 if 'kg' in quantity_and_price[1]:
@@ -35,50 +201,33 @@ def maxima_parser(html_content, verbose = False):
                     quantity_unit = 'pc'
                     quantity = int(quantity_and_price[1])
 
-            price = float(cells[2].text.strip().replace('€', '').replace(',', '.'))
+            price = float(cells[2].replace('€', '').replace(',', '.'))
             products.append({
                 'name': product_name,
                 'quantity': quantity,
                 'quantity unit':quantity_unit,
                 'price': price
             })
-        elif len(cells) == 2 and 'Discount' in cells[0].text:
-            discount = float(cells[1].text.strip().replace('€', '').replace('-', '').replace(',', '.'))
+        elif len(cells) == 2 and 'Discount' in cells[0]:
+            discount = float(cells[1].replace('€', '').replace('-', '').replace(',', '.'))
             products[-1]['discount'] = discount
-    products = pd.DataFrame(products)
+    products = pd.DataFrame(products, columns=['name', 'quantity', 'quantity unit', 'price', 'discount'])
 
     # Additional info from Discount product section
-    payments_table = soup.find('div', {'id':'payments'})
-    totalDiscounts = payments_table.find('tr', {'id':'totalDiscounts'})
-    ids_to_filter = ['aitahCard', 'receivedMaximaMoney', 'MaximaMoneyBalance']
-    all_trs_in_payments = payments_table.find_all('tr')
-    discounted_products = []
-    start_collecting = False
-    for tr in all_trs_in_payments:
-        if tr == totalDiscounts:
-            start_collecting = True
-            continue
-        if start_collecting:
-            if tr.attrs.get('id') not in ids_to_filter:
-                discounted_products.append(tr)
     discount_product_list = []
-
-    for product in discounted_products:
-        product_info = product.find_all('td')
+    for product_info in discount_rows:
         if len(product_info) == 2:
-            name = product_info[0].text.strip()
-            discount = float(product_info[1].text.strip().replace('€', '').replace(',', '.'))
+            name = product_info[0]
+            discount = float(product_info[1].replace('€', '').replace(',', '.'))
             discount_product_list.append({'name':name, 'discount':discount})
-    discount_product_list = pd.DataFrame(discount_product_list)
+    discount_product_list = pd.DataFrame(discount_product_list, columns=['name', 'discount'])
 
 
     # Merge discount and product list
-    def find_best_match(product_name, products):
-        # function to find the best match in the products based on name
-        matches = difflib.get_close_matches(product_name, products['name'], n=1, cutoff=0.1)
-        return matches[0] if matches else None
-
-    discount_product_list['matched_name'] = discount_product_list['name'].apply(lambda x: find_best_match(x, products))
+    matcher = ProductMatcher(products['name'])
+    matches = [matcher.match(name) for name in discount_product_list['name']]
+    discount_product_list['matched_name'] = [matched_name for matched_name, _ in matches]
+    discount_product_list['match_confidence'] = [confidence for _, confidence in matches]
 
     merged_df = pd.merge(
         products,
@@ -105,4 +254,25 @@ def maxima_parser(html_content, verbose = False):
         'products':merged_df
     }
 
-    return output
\ No newline at end of file
+    return output
+
+def parse_maxima_email(email_data):
+    # receipt in the format of EmailProcessor, lxml is used when it is installed
+    engine = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+    receipt = maxima_parser(email_data['content'], engine=engine)
+
+    products = receipt['products'].rename(columns={
+        'name_products': 'name',
+        'name_discounted': 'discount_name',
+        'quantity unit': 'quantity_unit'
+    })
+    items = products.astype(object).where(products.notna(), None).to_dict('records')
+
+    return {
+        "date": email_data['date'],
+        "store": "Maxima",
+        "address": receipt['location'],
+        "items": items,
+        "total": receipt['total'],
+        "payment_method": "Card" if "Makstud Pangakaardiga" in email_data['content'] else None
+    }
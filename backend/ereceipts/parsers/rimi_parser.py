@@ -1,12 +1,106 @@
+import io
 import re
 import pandas as pd
 import numpy as np
 from scipy.stats import zscore
 import cv2
 import pytesseract
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
 
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+POPPLER_PATH = r'C:/Program Files/poppler-24.07.0/Library/bin'
+
+def iter_pdf_pages(pdf_bytes, dpi=200, grayscale=False):
+    """
+    Renders the pages of a pdf one at a time, yields (page number, page count, image).
+    """
+    page_count = pdfinfo_from_bytes(pdf_bytes, poppler_path=POPPLER_PATH)['Pages']
+    for page_number in range(1, page_count + 1):
+        images = convert_from_bytes(
+            pdf_bytes,
+            dpi=dpi,
+            grayscale=grayscale,
+            first_page=page_number,
+            last_page=page_number,
+            poppler_path=POPPLER_PATH
+        )
+        yield page_number, page_count, np.array(images[0])
+
+def detect_dashed_lines(gray, scale=0.5, min_line_length=440, max_line_gap=15):
+    """
+    Finds the y positions of long horizontal (dashed) lines from the horizontal projection
+    profile of a downscaled binary image, mapped back to full resolution.
+    """
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, binary = cv2.threshold(small, 150, 255, cv2.THRESH_BINARY_INV)
+
+    # remove the text strokes, then bridge the gaps between the dashes
+    open_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(int(7 * scale), 2), 1))
+    morph = cv2.morphologyEx(binary, cv2.MORPH_OPEN, open_kernel, iterations=2)
+    close_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(int(max_line_gap * scale), 1) + 1, 1))
+    morph = cv2.morphologyEx(morph, cv2.MORPH_CLOSE, close_kernel)
+
+    profile = np.count_nonzero(morph, axis=1)
+    is_line = np.r_[False, profile >= min_line_length * scale, False]
+
+    # every run of consecutive line rows is one dashed line
+    edges = np.flatnonzero(np.diff(is_line.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    return [int((start + end - 1) / 2 / scale) for start, end in zip(starts, ends)]
+
+def has_text_layer(pdf_bytes):
+    try:
+        import pdfplumber
+    except ImportError:
+        return False
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return bool(pdf.pages) and bool(pdf.pages[0].extract_words())
+
+def iter_text_layer_pages(pdf_bytes, dpi=200):
+    """
+    Reads the embedded text layer of a digitally generated pdf page by page.
+    Yields (page number, page count, page shape, words, dashed lines), with the words in the
+    same format and pixel coordinates as pytesseract.image_to_data at the given dpi.
+    """
+    import pdfplumber
+
+    scale = dpi / 72 # pdf coordinates are in points
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        page_count = len(pdf.pages)
+        for page_number, page in enumerate(pdf.pages, start=1):
+            page_shape = (int(page.height * scale), int(page.width * scale))
+            words = pd.DataFrame(page.extract_words(), columns=['text', 'x0', 'x1', 'top', 'bottom'])
+            words = pd.DataFrame({
+                'left': words['x0'] * scale,
+                'top': words['top'] * scale,
+                'width': (words['x1'] - words['x0']) * scale,
+                'height': (words['bottom'] - words['top']) * scale,
+                'text': words['text'],
+                'conf': 100,
+            })
+
+            # same line structure as tesseract, so words_to_text can rebuild the text
+            words = words.sort_values(by='top').reset_index(drop=True)
+            epsilon = words['height'].median() / 2 if len(words) else 0
+            words['block_num'] = 1
+            words['par_num'] = 1
+            words['line_num'] = line_ids(words['top'].to_numpy(), epsilon)
+            words['word_num'] = words.groupby('line_num')['left'].rank(method='first')
+
+            # dashed lines are either text lines made of dashes or horizontal vector lines
+            line_text = words.groupby('line_num')['text'].agg(''.join)
+            dashed_line_nums = line_text[line_text.str.fullmatch(r'[-=_]{10,}')].index
+            is_dashes = words['line_num'].isin(dashed_line_nums)
+            dashes = words[is_dashes]
+            line_y = (dashes['top'] + dashes['height'] / 2).groupby(dashes['line_num']).mean()
+            dashed_lines = [int(y) for y in line_y.tolist()]
+
+            for edge in page.lines + page.rects:
+                if abs(edge['bottom'] - edge['top']) < 2 and edge['x1'] - edge['x0'] > 0.6 * page.width:
+                    dashed_lines.append(int((edge['top'] + edge['bottom']) / 2 * scale))
+
+            yield page_number, page_count, page_shape, words[~is_dashes].reset_index(drop=True), sorted(set(dashed_lines))
+            page.flush_cache()
 
 def crop_from(image, side='right', percentage=0.15):
     height, width = image.shape[:2]
@@ -61,61 +155,59 @@ def filter_discounts(df):
     name_info = name_info[name_info['text'].str.contains('Allah.')]
     return name_info.reset_index(drop=True)
 
+def line_ids(tops, epsilon=15):
+    """
+    Assigns a line id to every word, tops has to be sorted ascending.
+    A line starts at its topmost word and takes all words within epsilon below it,
+    so each line is found with a single binary search.
+    """
+    ids = np.empty(len(tops), dtype=np.int64)
+    start, line = 0, 0
+    while start < len(tops):
+        end = np.searchsorted(tops, tops[start] + epsilon, side='right')
+        ids[start:end] = line
+        start, line = end, line + 1
+    return ids
+
 def group_words_into_lines(df, epsilon=15):
     """
     Groups words into lines based on their vertical positions.
     """
+    if df.empty:
+        return []
+
     # Sort by top to help with grouping
     df = df.sort_values(by='top').reset_index(drop=True)
-    
-    # Initialize line grouping
-    line_groups = []
-    current_line = []
-    current_top = df.iloc[0]['top']
-    
-    for _, row in df.iterrows():
-        # If the word is within epsilon distance in vertical position, consider it the same line
-        if abs(row['top'] - current_top) <= epsilon:
-            current_line.append(row)
-        else:
-            # Move to the next line
-            line_groups.append(pd.DataFrame(current_line))
-            current_line = [row]
-            current_top = row['top']
-    
-    # Append the last line
-    if current_line:
-        line_groups.append(pd.DataFrame(current_line))
-    
-    return line_groups
+    ids = line_ids(df['top'].to_numpy(), epsilon)
+    line_starts = np.flatnonzero(np.diff(ids)) + 1
+    return [df.iloc[start:end] for start, end in zip(np.r_[0, line_starts], np.r_[line_starts, len(df)])]
 
 def concatenate_text_in_region(df, epsilon=15):
     """
     Concatenates text within each region, ordering words correctly within lines and lines within regions.
     """
-    # Group by region index
-    concatenated_texts = []
-    
-    for region_index, group in df.groupby('region_index'):
-        # Group words into lines
-        lines = group_words_into_lines(group, epsilon)
+    df = df[df['region_index'].notna()]
+    if df.empty:
+        return pd.DataFrame(columns=['region_index', 'concatenated_text'])
 
-        # Sort words within each line by their left (x) position
-        lines = [line.sort_values(by='left') for line in lines]
-        
-        # Sort lines by their top (y) position
-        lines = sorted(lines, key=lambda x: x['top'].mean())
-        
-        # Concatenate words in each line
-        concatenated_lines = [' '.join(line['text'].tolist()) for line in lines]
-        
-        # Concatenate all lines in the region
-        region_text = ' '.join(concatenated_lines)
-        
-        # Store result with region index
-        concatenated_texts.append({'region_index': region_index, 'concatenated_text': region_text})
-    
-    return pd.DataFrame(concatenated_texts)
+    # sort once by region and top, then find the lines of every region
+    df = df.sort_values(by=['region_index', 'top'])
+    regions = df['region_index'].to_numpy()
+    tops = df['top'].to_numpy()
+    region_starts = np.r_[0, np.flatnonzero(regions[1:] != regions[:-1]) + 1, len(df)]
+
+    ids = np.empty(len(df), dtype=np.int64)
+    line_offset = 0
+    for start, end in zip(region_starts[:-1], region_starts[1:]):
+        region_ids = line_ids(tops[start:end], epsilon)
+        ids[start:end] = region_ids + line_offset
+        line_offset += region_ids[-1] + 1
+
+    # line ids grow with region and top, so ordering by (line, left) orders words in reading order
+    order = np.lexsort((df['left'].to_numpy(), ids))
+    text = df.iloc[order].groupby('region_index', sort=True)['text'].agg(' '.join)
+
+    return pd.DataFrame({'region_index': text.index, 'concatenated_text': text.values})
 
 def parse_product_line(line):
     # Regular expressions for detecting quantities
@@ -163,24 +255,113 @@ def parse_product_line(line):
     return product_name, quantity, quantity_units
 
 
-class RimiParser():
-    def __init__(self, attachments):
-        pdf_io = [a for a in attachments if a['content-type'] == 'application/pdf'][0]['content']
-        pdf_io.getvalue()
+def words_to_text(df):
+    """
+    Rebuilds the text of image_to_data words, one line per tesseract text line.
+    """
+    if df.empty:
+        return ''
+    df = df.sort_values(by=['block_num', 'par_num', 'line_num', 'word_num'])
+    lines = df.groupby(['block_num', 'par_num', 'line_num'], sort=False)['text'].apply(' '.join)
+    return '\n'.join(lines.tolist())
+
 
-        # use ocr
-        images = convert_from_bytes(pdf_io.getvalue(), poppler_path=r'C:/Program Files/poppler-24.07.0/Library/bin')
-        self.image = np.array(images[0]) # TODO there could be multiple attachemnts?
+class RimiParser():
+    def __init__(self, attachments, ocr_mode='single', dpi=200, grayscale=False, use_text_layer=True):
+        self.pdfs = [a['content'].getvalue() for a in attachments if a['content-type'] == 'application/pdf']
+        if not self.pdfs:
+            raise ValueError('No pdf attachment found')
+
+        # pages are rendered lazily in run, only one page is kept in memory at a time
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.image = None
         self.price_product_thr = 0.75 # vertical line to separate prices
+        # 'single' runs tesseract once over the whole page and splits the words by their coordinates,
+        # 'regions' runs it separately on every region of interest
+        self.ocr_mode = ocr_mode
+        self.ocr_config = ''
+        self.dashed_line_scale = 0.5 # dashed lines are detected on a downscaled page
+        # digitally generated pdfs are read from their text layer, OCR is only the fallback
+        self.use_text_layer = use_text_layer
+        self.source = None
+
+    def run_all(self):
+        # every pdf attachment is a separate receipt
+        return [self.run(pdf_index) for pdf_index in range(len(self.pdfs))]
+
+    def run(self, pdf_index=0):
+        """
+        Parses one pdf attachment page by page. The store info is read from the first page,
+        the date from the last one and the products of all pages are stitched together.
+        """
+        results = {'location': None, 'products': None, 'dtime': None}
+        page_products = []
+        region_offset = 0
+        for page_results in self.iter_page_results(self.pdfs[pdf_index]):
+            if 'location' in page_results:
+                results['location'] = page_results['location']
+            if 'dtime' in page_results:
+                results['dtime'] = page_results['dtime']
+            # keep the product region indices unique over all pages
+            products = page_results['products'].copy()
+            products['region_index'] = products['region_index'] + region_offset
+            region_offset += len(self.new_product_borders) - 1
+            page_products.append(products)
+
+        results['products'] = pd.concat(page_products, ignore_index=True)
+        return results
 
-    def run(self):
+    def iter_page_results(self, pdf_bytes):
+        if self.use_text_layer and has_text_layer(pdf_bytes):
+            self.source = 'text_layer'
+            for page_number, page_count, page_shape, words, dashed_lines in iter_text_layer_pages(pdf_bytes, self.dpi):
+                if page_number == 1 and len(dashed_lines) < 2:
+                    # the section separators are not in the text layer, use OCR instead
+                    break
+                self.image = None
+                self.page_shape = page_shape
+                self.dashed_lines = dashed_lines
+                self.roi_list = self.get_regions(is_first=page_number == 1, is_last=page_number == page_count)
+                # the text layer has no OCR noise, so the price outlier filter is not needed
+                yield self.parse_words(words, filter_prices=False)
+            else:
+                return
+
+        self.source = 'ocr'
+        for page_number, page_count, image in iter_pdf_pages(pdf_bytes, self.dpi, self.grayscale):
+            self.image = image
+            self.page_shape = image.shape[:2]
+            yield self.run_page(is_first=page_number == 1, is_last=page_number == page_count)
+
+    def get_regions(self, is_first=True, is_last=True):
+        height = self.page_shape[0]
+        roi_list = {}
+
+        product_start = 0
+        if is_first:
+            # the store info and the product list both need their separators on the first page
+            if len(self.dashed_lines) < 2:
+                raise RuntimeError(f'Expected at least 2 dashed lines on the first page, detected {len(self.dashed_lines)}')
+            roi_list['store_info'] = (0, self.dashed_lines[0])
+            product_start = self.dashed_lines[1]
+
+        # on pages before the last one the products continue until the end of the page
+        lines_below = [y for y in self.dashed_lines if y > product_start]
+        product_end = lines_below[0] if is_last and lines_below else height
+        roi_list['product_list'] = (product_start, product_end)
+
+        if is_last and self.dashed_lines:
+            roi_list['total_info'] = (self.dashed_lines[-1], height)
+        return roi_list
+
+    def run_page(self, is_first=True, is_last=True):
         self.detect_dashed_regions()
+        self.roi_list = self.get_regions(is_first, is_last)
+
+        if self.ocr_mode == 'single':
+            return self.run_single_pass()
 
-        self.roi_list = {
-            'store_info': (0,self.dashed_lines[0]),
-            'product_list': (self.dashed_lines[1],self.dashed_lines[2]),
-            'total_info': (self.dashed_lines[-1],self.image.shape[0])
-        }
         # process each region of interest separately
         results = {}
         for section_name, (start_y, end_y) in self.roi_list.items():
@@ -197,20 +378,46 @@ class RimiParser():
 
         return results
 
-    def detect_dashed_regions(self):
-        gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-        _, binary = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY_INV)
+    def run_single_pass(self):
+        words = pd.DataFrame(pytesseract.image_to_data(self.image, output_type='dict', config=self.ocr_config))
+        words['conf'] = pd.to_numeric(words['conf'])
+        words = words[(words['conf'] != -1) & (words['text'].str.strip() != '')]
+        return self.parse_words(words)
+
+    def parse_words(self, words, filter_prices=True):
+        """
+        Splits the words of the whole page into the regions of interest by their coordinates
+        and parses every region. Coordinates are moved into the frame of each region,
+        the same as if the region had been cropped before the OCR.
+        """
+        words = words.copy()
+        y_center = words['top'] + words['height'] / 2
+        results = {}
+        for section_name, (start_y, end_y) in self.roi_list.items():
+            section = words[(y_center >= start_y) & (y_center < end_y)].copy()
+            section['top'] -= start_y
 
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 1)) # horizontal line
-        morph = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=2)
+            if section_name == 'store_info':
+                results['location'] = self.parse_store_info(words_to_text(section))
+            elif section_name == 'product_list':
+                width = self.page_shape[1]
+                price_offset = width - int(width * (1 - self.price_product_thr))
+                is_price = section['left'] + section['width'] / 2 >= price_offset
+
+                price_info = section[is_price].copy()
+                price_info['left'] -= price_offset
+                name_info = section[~is_price].copy()
+                results['products'] = self.group_products(name_info, price_info, end_y - start_y, filter_prices)
+            elif section_name == 'total_info':
+                results['dtime'] = self.parse_total_info(words_to_text(section))
 
-        imgLines= cv2.HoughLinesP(morph, 10, np.pi/180, 20, minLineLength = 440, maxLineGap = 15)
+        return results
 
-        if len(imgLines) == 0:
-            raise RuntimeError('No dashed lines detected')
+    def detect_dashed_regions(self):
+        gray = self.image if self.image.ndim == 2 else cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
 
-        self.dashed_lines = [int((line[0][1]+line[0][3])/2) for line in imgLines]
-        self.dashed_lines = sorted(self.dashed_lines)
+        # pages in the middle of a long receipt don't have any dashed lines
+        self.dashed_lines = detect_dashed_lines(gray, scale=self.dashed_line_scale)
 
     def parse_store_info(self, text):
         # Find the address lines by splitting the text and looking for patterns
@@ -235,52 +442,42 @@ class RimiParser():
         price_section = crop_from(roi, side='right',percentage=1-self.price_product_thr)
         name_section = crop_from(roi, side='left',percentage=self.price_product_thr)
 
-        self.price_info =  pytesseract.image_to_data(price_section, output_type='dict', config='--psm 11')
-        self.price_info = pd.DataFrame(self.price_info)
-        print(self.price_info)
-        self.price_info = filter_price_info(self.price_info)
-        print(self.price_info)
-        
-        self.name_info = pytesseract.image_to_data(name_section, output_type='dict')
-        self.name_info = pd.DataFrame(self.name_info)
-        self.name_info = self.name_info[self.name_info['conf']!=-1]
+        price_info = pd.DataFrame(pytesseract.image_to_data(price_section, output_type='dict', config='--psm 11'))
+        name_info = pd.DataFrame(pytesseract.image_to_data(name_section, output_type='dict'))
+
+        return self.group_products(name_info, price_info, roi.shape[0])
+
+    def group_products(self, name_info, price_info, roi_height, filter_prices=True):
+        """
+        Groups the OCR words of the product list into products, using the discount lines
+        and the prices as product borders.
+        """
+        self.price_info = price_info.reset_index(drop=True)
+        if filter_prices:
+            self.price_info = filter_price_info(self.price_info)
+        self.name_info = name_info[name_info['conf']!=-1].copy()
         discount_info = filter_discounts(self.name_info)
 
         # save raw detections for vizualization
         self.raw_name_info = self.name_info.copy()
         self.raw_price_info = self.price_info.copy()
 
-        product_borders = []
-        for ind,row in discount_info.iterrows():
-            (x, y, w, h) = (row['left'], row['top'], row['width'], row['height'])
-            product_borders.append({'type':'name','y':y+h})
-
-        for ind,row in self.price_info.iterrows():
-            (x, y, w, h) = (row['left'], row['top'], row['width'], row['height'])
-            product_borders.append({'type':'price','y':y+h})
-
-        product_borders = pd.DataFrame(product_borders)
-        product_borders = product_borders.sort_values(by='y', ascending = True).drop_duplicates(subset=['type','y']).reset_index(drop=True)
-
-        # product borders refinement
-        self.new_product_borders = []
-
-        product_start = True
-        for ind, row in product_borders.iterrows():
-            if ind != product_borders.shape[0]-1:
-                if product_start and row['type'] == 'price' and product_borders.loc[ind+1, 'type'] == 'price':
-                    product_start = False
-                elif product_start and row['type'] == 'name':
-                    product_start = False
-            else:
-                product_start = False
-            
-            if not product_start:
-                # product border detected
-                self.new_product_borders.append(row['y'])
-                product_start = True
-
-        self.new_product_borders = [0] + self.new_product_borders + [roi.shape[0]]
+        product_borders = pd.concat([
+            pd.DataFrame({'type': 'name', 'y': discount_info['top'] + discount_info['height']}),
+            pd.DataFrame({'type': 'price', 'y': self.price_info['top'] + self.price_info['height']}),
+        ], ignore_index=True)
+        product_borders = product_borders.sort_values(by='y', ascending = True, kind='stable').drop_duplicates(subset=['type','y']).reset_index(drop=True)
+
+        # product borders refinement: a border is placed after every discount line,
+        # after a price that is followed by another price, and after the last detection
+        types = product_borders['type'].to_numpy()
+        next_is_price = np.append(types[1:] == 'price', False)
+        is_border = (types == 'name') | ((types == 'price') & next_is_price)
+        if len(is_border):
+            is_border[-1] = True
+        self.new_product_borders = product_borders.loc[is_border, 'y'].tolist()
+
+        self.new_product_borders = [0] + self.new_product_borders + [roi_height]
         self.new_product_borders = sorted(list(set(self.new_product_borders)))
 
         # group info based on the detected product borders
@@ -332,7 +529,12 @@ class RimiParser():
         return None
 
     def vizualize(self):
+        # shows the last rendered page
+        if self.image is None:
+            raise RuntimeError('Nothing to visualize, the receipt was read from the pdf text layer')
         self.viz = self.image.copy()
+        if self.viz.ndim == 2:
+            self.viz = cv2.cvtColor(self.viz, cv2.COLOR_GRAY2BGR)
         new_width = self.viz.shape[1] + 150
 
         extended_viz = np.zeros((self.viz.shape[0], new_width, 3), dtype=np.uint8)
@@ -374,3 +576,28 @@ class RimiParser():
         cv2.addWeighted(overlay, alpha, extended_viz, 1 - alpha, 0, extended_viz)
         return extended_viz
 
+
+
+def parse_rimi_email(email_data):
+    # one receipt in the format of EmailProcessor for every pdf attachment
+    receipts = []
+    for receipt in RimiParser(email_data['attachments']).run_all():
+        items = []
+        for name, price in receipt['products'][['name', 'price']].itertuples(index=False):
+            product_name, quantity, quantity_units = parse_product_line(name)
+            items.append({
+                "name": product_name,
+                "quantity": quantity,
+                "quantity_unit": quantity_units,
+                "price": price if isinstance(price, str) else None
+            })
+
+        receipts.append({
+            "date": email_data['date'],
+            "store": "Rimi",
+            "address": receipt['location'],
+            "items": items,
+            "total": None,
+            "payment_method": None
+        })
+    return receipts
@@ -0,0 +1,119 @@
+import os
+import gzip
+import hashlib
+
+
+class RawEmailCache:
+    """
+    Content addressed store of raw RFC822 emails on the local disk.
+    Keys are the sha256 of the Message-ID (or of the raw bytes when there is none),
+    files are spread over 256 sub directories and optionally gzip compressed.
+    When max_bytes is set, the least recently used files are evicted above that size, down to
+    low_water * max_bytes so the cache isn't walked again on every following put.
+    An evicted marker file records that the cache no longer holds every email, until a full
+    sync has put them all back, see clear_evicted.
+    """
+    EVICTED_MARKER = '.evicted'
+
+    def __init__(self, root, compress=True, max_bytes=None, low_water=0.9):
+        self.root = root
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.total_bytes = None
+        # number of evict() calls that removed files, to tell whether a sync lost emails
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(message_id=None, raw=None):
+        if message_id:
+            return hashlib.sha256(message_id.strip().encode('utf-8')).hexdigest()
+        return hashlib.sha256(raw).hexdigest()
+
+    def _paths(self, key):
+        directory = os.path.join(self.root, key[:2])
+        return os.path.join(directory, key + '.eml.gz'), os.path.join(directory, key + '.eml')
+
+    def _find(self, key):
+        for path in self._paths(key):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def get(self, key):
+        path = self._find(key)
+        if path is None:
+            return None
+        # mtime is used as the last access time for the eviction
+        os.utime(path)
+        return self._read(path)
+
+    def _read(self, path):
+        if path.endswith('.gz'):
+            with gzip.open(path, 'rb') as f:
+                return f.read()
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, key, raw):
+        path = self._paths(key)[0 if self.compress else 1]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        replaced_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = path + '.tmp'
+        if self.compress:
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(raw)
+        else:
+            with open(tmp_path, 'wb') as f:
+                f.write(raw)
+        os.replace(tmp_path, path)
+
+        if self.max_bytes is not None:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self.total_bytes += os.path.getsize(path) - replaced_bytes
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def _entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith('.eml') or name.endswith('.eml.gz'):
+                    path = os.path.join(directory, name)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = self.max_bytes * self.low_water
+        evicted = False
+        for path, size, _ in entries:
+            if total_bytes <= target_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            evicted = True
+        self.total_bytes = total_bytes
+
+        if evicted:
+            self.evictions += 1
+            # the cache no longer holds the full history, see has_evicted
+            open(os.path.join(self.root, self.EVICTED_MARKER), 'w').close()
+
+    def has_evicted(self):
+        return os.path.exists(os.path.join(self.root, self.EVICTED_MARKER))
+
+    def clear_evicted(self):
+        try:
+            os.remove(os.path.join(self.root, self.EVICTED_MARKER))
+        except FileNotFoundError:
+            pass
+
+    def iter_raw(self):
+        for path, _, _ in self._entries():
+            yield self._read(path)
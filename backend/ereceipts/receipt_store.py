@@ -0,0 +1,167 @@
+import os
+import sqlite3
+
+from imap_utils import chunked
+from normalize import parse_amount, parse_date
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stores (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    address TEXT NOT NULL DEFAULT '',
+    UNIQUE (name, address)
+);
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    receipt_index INTEGER NOT NULL DEFAULT 0,
+    store_id INTEGER REFERENCES stores(id),
+    date TEXT,
+    total REAL,
+    payment_method TEXT,
+    UNIQUE (message_id, receipt_index)
+);
+CREATE TABLE IF NOT EXISTS items (
+    receipt_id INTEGER NOT NULL REFERENCES receipts(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT,
+    quantity REAL,
+    quantity_unit TEXT,
+    price REAL,
+    PRIMARY KEY (receipt_id, position)
+);
+CREATE TABLE IF NOT EXISTS discounts (
+    receipt_id INTEGER NOT NULL REFERENCES receipts(id) ON DELETE CASCADE,
+    item_position INTEGER NOT NULL,
+    name TEXT,
+    amount REAL,
+    match_confidence REAL
+);
+CREATE INDEX IF NOT EXISTS receipts_date ON receipts (date);
+CREATE INDEX IF NOT EXISTS receipts_store_date ON receipts (store_id, date);
+CREATE INDEX IF NOT EXISTS items_name ON items (name);
+CREATE INDEX IF NOT EXISTS discounts_receipt ON discounts (receipt_id);
+CREATE INDEX IF NOT EXISTS stores_name ON stores (name);
+"""
+
+
+class ReceiptStore:
+    """
+    SQLite storage of parsed receipts. Receipts are upserted by (message_id, receipt_index),
+    so running the import again over the same emails doesn't create duplicates.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        self.store_ids = {}
+
+    def get_store_id(self, name, address):
+        key = (name or '', address or '')
+        if key not in self.store_ids:
+            self.connection.execute("INSERT OR IGNORE INTO stores (name, address) VALUES (?, ?)", key)
+            self.store_ids[key] = self.connection.execute(
+                "SELECT id FROM stores WHERE name = ? AND address = ?", key
+            ).fetchone()[0]
+        return self.store_ids[key]
+
+    def upsert_receipts(self, receipts):
+        """
+        Writes a batch of receipts in a single transaction.
+        """
+        with self.connection:
+            for receipt in receipts:
+                self._upsert(receipt)
+
+    def _upsert(self, receipt):
+        date = parse_date(receipt.get('date'))
+        receipt_key = (receipt['message_id'], receipt.get('receipt_index', 0))
+        self.connection.execute("""
+            INSERT INTO receipts (message_id, receipt_index, store_id, date, total, payment_method)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (message_id, receipt_index) DO UPDATE SET
+                store_id = excluded.store_id,
+                date = excluded.date,
+                total = excluded.total,
+                payment_method = excluded.payment_method
+        """, (
+            *receipt_key,
+            self.get_store_id(receipt.get('store'), receipt.get('address')),
+            date.isoformat() if date else None,
+            parse_amount(receipt.get('total')),
+            receipt.get('payment_method')
+        ))
+        receipt_id = self.connection.execute(
+            "SELECT id FROM receipts WHERE message_id = ? AND receipt_index = ?", receipt_key
+        ).fetchone()[0]
+
+        # line items are replaced as a whole, the parser output may have changed
+        self.connection.execute("DELETE FROM items WHERE receipt_id = ?", (receipt_id,))
+        self.connection.execute("DELETE FROM discounts WHERE receipt_id = ?", (receipt_id,))
+
+        items = []
+        discounts = []
+        for position, item in enumerate(receipt.get('items', [])):
+            items.append((
+                receipt_id,
+                position,
+                item.get('name'),
+                parse_amount(item.get('quantity')),
+                item.get('quantity_unit'),
+                parse_amount(item.get('price'))
+            ))
+            if parse_amount(item.get('discount')) is not None:
+                discounts.append((
+                    receipt_id,
+                    position,
+                    item.get('discount_name'),
+                    parse_amount(item.get('discount')),
+                    parse_amount(item.get('match_confidence'))
+                ))
+
+        self.connection.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)", items)
+        self.connection.executemany("INSERT INTO discounts VALUES (?, ?, ?, ?, ?)", discounts)
+
+    def iter_upsert(self, receipts, batch_size=500):
+        """
+        Stores receipts in batches while passing them through, for use in the streaming pipeline.
+        """
+        for batch in chunked(receipts, batch_size):
+            self.upsert_receipts(batch)
+            yield from batch
+
+    def spend(self, store=None, start=None, end=None):
+        """
+        Total spend, optionally for one store and a [start, end) date range, e.g.
+        store.spend('Maxima', '2024-05-01', '2024-06-01').
+        """
+        query = "SELECT COALESCE(SUM(r.total), 0) FROM receipts r JOIN stores s ON s.id = r.store_id WHERE 1 = 1"
+        params = []
+        if store is not None:
+            query += " AND s.name = ?"
+            params.append(store)
+        if start is not None:
+            query += " AND r.date >= ?"
+            params.append(str(start))
+        if end is not None:
+            query += " AND r.date < ?"
+            params.append(str(end))
+        return self.connection.execute(query, params).fetchone()[0]
+
+    def item_history(self, name):
+        return self.connection.execute("""
+            SELECT r.date, s.name, i.name, i.quantity, i.quantity_unit, i.price
+            FROM items i
+            JOIN receipts r ON r.id = i.receipt_id
+            JOIN stores s ON s.id = r.store_id
+            WHERE i.name = ?
+            ORDER BY r.date
+        """, (name,)).fetchall()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,160 @@
+import os
+import glob
+from datetime import datetime
+import pandas as pd
+from normalize import normalize_records
+
+
+class RecordSink:
+    """
+    Consumes records one by one and writes them out in chunks of chunk_size,
+    so memory doesn't grow with the number of processed receipts.
+    """
+    def __init__(self, path, chunk_size=1000, append=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.append = append
+        self.buffer = []
+        self.count = 0
+
+    def write(self, records):
+        for record in records:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.write_chunk(pd.DataFrame(self.buffer))
+        self.count += len(self.buffer)
+        self.buffer = []
+
+    def write_chunk(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvSink(RecordSink):
+    def write_chunk(self, df):
+        append = self.append and os.path.exists(self.path)
+        df.to_csv(self.path, mode='a' if append else 'w', header=not append, index=False)
+        # every following chunk goes to the end of the same file
+        self.append = True
+
+
+class ParquetSink(RecordSink):
+    """
+    Writes a parquet dataset directory, each run adds a new part file with one row group per chunk.
+    Like the csv output every column is written as text, the parsers don't agree on value types
+    (e.g. Maxima prices are floats, Bolt prices "€12.50"), TypedParquetSink has the parsed values.
+    """
+    def __init__(self, path, chunk_size=1000, append=False):
+        super().__init__(path, chunk_size, append)
+        self.writer = None
+        self.schema = None
+
+    @staticmethod
+    def as_text(df):
+        # missing values stay null instead of becoming "None"/"nan"
+        return df.astype(str).astype(object).where(df.notna(), None)
+
+    def write_chunk(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.writer is None:
+            os.makedirs(self.path, exist_ok=True)
+            if not self.append:
+                for part in glob.glob(os.path.join(self.path, '*.parquet')):
+                    os.remove(part)
+
+            self.schema = pa.schema([(column, pa.string()) for column in df.columns])
+
+            part_name = f"part-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.parquet"
+            self.writer = pq.ParquetWriter(os.path.join(self.path, part_name), self.schema)
+
+        df = self.as_text(df.reindex(columns=self.schema.names))
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class TypedParquetSink(RecordSink):
+    """
+    Writes typed records to a parquet dataset partitioned by month (month=YYYY-MM directories),
+    amounts are float64, the date a UTC timestamp and store, address, item_quantity_unit and
+    payment_method are dictionary encoded. Each run adds one part file to every month it has records for.
+    """
+    def __init__(self, path, chunk_size=1000, append=False):
+        super().__init__(path, chunk_size, append)
+        self.writers = {}
+        self.schema = None
+
+    def get_schema(self):
+        import pyarrow as pa
+
+        category = pa.dictionary(pa.int32(), pa.string())
+        return pa.schema([
+            ('date', pa.timestamp('us', tz='UTC')),
+            ('store', category),
+            ('address', category),
+            ('item_name', pa.string()),
+            ('item_quantity', pa.float64()),
+            ('item_quantity_unit', category),
+            ('item_price', pa.float64()),
+            ('total', pa.float64()),
+            ('payment_method', category),
+        ])
+
+    def get_writer(self, month):
+        import pyarrow.parquet as pq
+
+        if month not in self.writers:
+            directory = os.path.join(self.path, f"month={month}")
+            os.makedirs(directory, exist_ok=True)
+            part_name = f"part-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.parquet"
+            self.writers[month] = pq.ParquetWriter(os.path.join(directory, part_name), self.schema)
+        return self.writers[month]
+
+    def write_chunk(self, df):
+        import pyarrow as pa
+
+        if self.schema is None:
+            self.schema = self.get_schema()
+            if not self.append:
+                for part in glob.glob(os.path.join(self.path, '**', '*.parquet'), recursive=True):
+                    os.remove(part)
+
+        df = normalize_records(df)
+        for month, month_df in df.groupby('month', observed=True, sort=False):
+            table = pa.Table.from_pandas(
+                month_df.reindex(columns=self.schema.names), schema=self.schema, preserve_index=False
+            )
+            self.get_writer(month).write_table(table)
+
+    def close(self):
+        super().close()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+def open_sink(path, chunk_size=1000, append=False, typed=False):
+    if typed:
+        return TypedParquetSink(path, chunk_size, append)
+    if path.endswith('.parquet'):
+        return ParquetSink(path, chunk_size, append)
+    return CsvSink(path, chunk_size, append)
@@ -0,0 +1,50 @@
+import json
+import os
+
+
+class SyncCheckpoint:
+    """
+    Persists the UIDVALIDITY and the last synced UID of every IMAP folder, and the UIDs
+    at or below it whose receipts failed to parse, so they are retried on the next run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get_last_uid(self, folder, uidvalidity):
+        folder_state = self.state.get(folder)
+        # UIDs are only comparable within the same UIDVALIDITY, otherwise do a full resync
+        if folder_state is None or folder_state['uidvalidity'] != uidvalidity:
+            return 0
+        return folder_state['last_uid']
+
+    def get_failed_uids(self, folder, uidvalidity):
+        folder_state = self.state.get(folder)
+        if folder_state is None or folder_state['uidvalidity'] != uidvalidity:
+            return []
+        return folder_state.get('failed_uids', [])
+
+    def update(self, folder, uidvalidity, last_uid, failed_uids=()):
+        self.state[folder] = {
+            'uidvalidity': uidvalidity,
+            'last_uid': last_uid,
+            'failed_uids': sorted(set(failed_uids))
+        }
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # write to a temp file first so a crash never leaves a half written checkpoint
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
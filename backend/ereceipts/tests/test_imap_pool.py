@@ -0,0 +1,117 @@
+import imaplib
+import random
+import threading
+import time
+
+import pytest
+
+from imap_pool import IMAPConnectionPool
+
+
+class FakeConnection:
+    """
+    Answers UID FETCH with one message per UID of the set, payload b'body <uid>'.
+    fail_next makes the next fetches of any connection raise the given exceptions, in order.
+    """
+    opened = []
+
+    def __init__(self, fail_next=None, delay=0.0):
+        self.fail_next = fail_next if fail_next is not None else []
+        self.delay = delay
+        self.selected = None
+        self.closed = False
+        self.opened.append(self)
+
+    def select(self, folder):
+        self.selected = folder
+
+    def uid(self, command, uid_set, query):
+        assert command == "fetch"
+        if self.fail_next:
+            raise self.fail_next.pop(0)
+        time.sleep(random.uniform(0, self.delay))
+        if uid_set == "missing":
+            return 'NO', [b'no such message']
+        data = []
+        for uid in uid_set.split(','):
+            data.append((f'{uid} (UID {uid} RFC822 {{7}}'.encode(), f'body {uid}'.encode()))
+            data.append(b')')
+        return 'OK', data
+
+    def shutdown(self):
+        self.closed = True
+
+    def logout(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def reset_opened():
+    FakeConnection.opened = []
+
+
+def test_fetch_keeps_the_order_of_the_uid_sets():
+    random.seed(0)
+    pool = IMAPConnectionPool(lambda: FakeConnection(delay=0.01), "INBOX", size=4)
+    uid_sets = [str(uid) for uid in range(1, 41)]
+
+    results = list(pool.fetch(uid_sets, "(UID RFC822)"))
+    pool.close()
+
+    assert results == [(uid, f'body {uid}'.encode()) for uid in range(1, 41)]
+    assert 1 <= len(FakeConnection.opened) <= 4
+    assert all(connection.selected == "INBOX" for connection in FakeConnection.opened)
+
+
+def test_pool_never_opens_more_than_size_connections():
+    in_use = []
+    lock = threading.Lock()
+    peak = [0]
+
+    class CountingConnection(FakeConnection):
+        def uid(self, command, uid_set, query):
+            with lock:
+                in_use.append(self)
+                peak[0] = max(peak[0], len(in_use))
+            try:
+                return super().uid(command, uid_set, query)
+            finally:
+                with lock:
+                    in_use.remove(self)
+
+    pool = IMAPConnectionPool(lambda: CountingConnection(delay=0.01), "INBOX", size=3)
+    list(pool.fetch([str(uid) for uid in range(30)], "(UID RFC822)"))
+    pool.close()
+
+    assert len(FakeConnection.opened) <= 3
+    assert peak[0] <= 3
+
+
+def test_dropped_connection_is_replaced_and_retried():
+    failures = [imaplib.IMAP4.abort("socket closed")]
+    pool = IMAPConnectionPool(lambda: FakeConnection(fail_next=failures), "INBOX", size=1, retries=2)
+
+    assert pool.fetch_batch("5,6", "(UID RFC822)") == [(5, b'body 5'), (6, b'body 6')]
+    # the dropped connection was shut down and a new one opened for the retry
+    assert len(FakeConnection.opened) == 2
+    assert FakeConnection.opened[0].closed
+    assert pool.created == 1
+
+
+def test_retries_give_up_after_the_limit():
+    failures = [OSError("reset")] * 3
+    pool = IMAPConnectionPool(lambda: FakeConnection(fail_next=failures), "INBOX", size=1, retries=2)
+
+    with pytest.raises(OSError):
+        pool.fetch_batch("1", "(UID RFC822)")
+    assert pool.created == 0
+
+
+def test_refused_fetch_raises_without_retrying():
+    pool = IMAPConnectionPool(FakeConnection, "INBOX", size=2, retries=2)
+
+    with pytest.raises(imaplib.IMAP4.error):
+        pool.fetch_batch("missing", "(UID RFC822)")
+    # a NO answer doesn't drop the connection, it goes back to the pool
+    assert len(FakeConnection.opened) == 1
+    assert pool.idle.qsize() == 1
@@ -0,0 +1,74 @@
+from datetime import date
+
+from imap_utils import compress_uid_set, chunked, parse_fetch_response, ascii_search_term, build_search_query
+
+FILTERS = [
+    {"sender": "noreply.tsekk@maxima.ee", "subject": "Sinu ostutšekk!"},
+    {"sender": "noreply@rimibaltic.com", "subject": "Sinu ostutšekk"},
+    {"sender": "estonia-food@bolt.eu", "subject": "Delivery from Bolt Food"},
+]
+
+
+def test_compress_uid_set():
+    assert compress_uid_set([1, 2, 3, 7]) == "1:3,7"
+    assert compress_uid_set([9, 3, 2, 2, 10, 5]) == "2:3,5,9:10"
+    assert compress_uid_set(["4"]) == "4"
+    assert compress_uid_set([]) == ""
+
+
+def test_chunked():
+    assert list(chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 3)) == []
+
+
+def test_parse_fetch_response():
+    data = [
+        (b'1 (UID 10 RFC822 {5}', b'first'),
+        b')',
+        (b'2 (UID 11 RFC822 {6}', b'second'),
+        b')',
+    ]
+    assert list(parse_fetch_response(data)) == [(10, b'first'), (11, b'second')]
+
+
+def test_parse_fetch_response_uid_after_literal():
+    data = [
+        (b'1 (RFC822 {5}', b'first'),
+        b' UID 42)',
+        (b'2 (UID 43 RFC822 {6}', b'second'),
+    ]
+    assert list(parse_fetch_response(data)) == [(42, b'first'), (43, b'second')]
+
+
+def test_parse_fetch_response_skips_parts_without_uid():
+    data = [(b'1 (RFC822 {5}', b'first'), b')', (b'2 (UID 7 RFC822 {1}', b'x'), b')']
+    assert list(parse_fetch_response(data)) == [(7, b'x')]
+
+
+def test_ascii_search_term():
+    assert ascii_search_term("Sinu ostutšekk!") == "Sinu ostut"
+    assert ascii_search_term("Delivery from Bolt Food") == "Delivery from Bolt Food"
+    assert ascii_search_term("ššš ab") is None
+
+
+def test_build_search_query():
+    assert build_search_query(FILTERS) == (
+        'UID 1:* '
+        'OR (FROM "noreply.tsekk@maxima.ee" SUBJECT "Sinu ostut") '
+        'OR (FROM "noreply@rimibaltic.com" SUBJECT "Sinu ostut") '
+        '(FROM "estonia-food@bolt.eu" SUBJECT "Delivery from Bolt Food")'
+    )
+
+
+def test_build_search_query_incremental_since():
+    query = build_search_query(FILTERS[2:], last_uid=41, since=date(2024, 3, 5))
+    assert query == 'UID 42:* SINCE 5-Mar-2024 (FROM "estonia-food@bolt.eu" SUBJECT "Delivery from Bolt Food")'
+
+
+def test_build_search_query_is_ascii_and_quoted():
+    query = build_search_query([
+        {"sender": 'a"b@example.com', "subject": "ääää"},
+        {"sender": "c@example.com", "subject": 'say "hi"'},
+    ])
+    query.encode('ascii')
+    assert query == 'UID 1:* OR (FROM "a\\"b@example.com") (FROM "c@example.com" SUBJECT "say \\"hi\\"")'
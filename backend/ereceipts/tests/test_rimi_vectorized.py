@@ -0,0 +1,119 @@
+"""
+The vectorized Rimi layout helpers against the row by row implementations they replaced.
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+for module in ("scipy", "cv2", "pytesseract", "pdf2image"):
+    pytest.importorskip(module)
+
+from parsers.rimi_parser import RimiParser, group_words_into_lines, concatenate_text_in_region
+
+
+def old_group_words_into_lines(df, epsilon=15):
+    df = df.sort_values(by='top').reset_index(drop=True)
+    line_groups = []
+    current_line = []
+    current_top = df.iloc[0]['top']
+    for _, row in df.iterrows():
+        if abs(row['top'] - current_top) <= epsilon:
+            current_line.append(row)
+        else:
+            line_groups.append(pd.DataFrame(current_line))
+            current_line = [row]
+            current_top = row['top']
+    if current_line:
+        line_groups.append(pd.DataFrame(current_line))
+    return line_groups
+
+
+def old_concatenate_text_in_region(df, epsilon=15):
+    concatenated_texts = []
+    for region_index, group in df.groupby('region_index'):
+        lines = old_group_words_into_lines(group, epsilon)
+        lines = [line.sort_values(by='left') for line in lines]
+        lines = sorted(lines, key=lambda x: x['top'].mean())
+        region_text = ' '.join(' '.join(line['text'].tolist()) for line in lines)
+        concatenated_texts.append({'region_index': region_index, 'concatenated_text': region_text})
+    return pd.DataFrame(concatenated_texts)
+
+
+def old_product_borders(product_borders, roi_height):
+    borders = []
+    product_start = True
+    for ind, row in product_borders.iterrows():
+        if ind != product_borders.shape[0]-1:
+            if product_start and row['type'] == 'price' and product_borders.loc[ind+1, 'type'] == 'price':
+                product_start = False
+            elif product_start and row['type'] == 'name':
+                product_start = False
+        else:
+            product_start = False
+        if not product_start:
+            borders.append(row['y'])
+            product_start = True
+    return sorted(set([0] + borders + [roi_height]))
+
+
+def random_words(rng, n, regions=None):
+    # distinct tops and lefts, so the unstable sorts of the old implementation have no ties to reorder
+    df = pd.DataFrame({
+        'top': rng.permutation(n * 4)[:n],
+        'left': rng.permutation(n * 7)[:n],
+        'text': [f'w{i}' for i in range(n)],
+    })
+    if regions is not None:
+        df['region_index'] = rng.integers(0, regions, n).astype(float)
+        df.loc[rng.random(n) < 0.1, 'region_index'] = np.nan
+    return df
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("epsilon", [0, 10, 30])
+def test_group_words_into_lines(seed, epsilon):
+    df = random_words(np.random.default_rng(seed), 60)
+
+    new = group_words_into_lines(df, epsilon)
+    old = old_group_words_into_lines(df, epsilon)
+
+    assert [line['text'].tolist() for line in new] == [line['text'].tolist() for line in old]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("epsilon", [10, 30])
+def test_concatenate_text_in_region(seed, epsilon):
+    df = random_words(np.random.default_rng(seed), 80, regions=6)
+
+    new = concatenate_text_in_region(df, epsilon)
+    old = old_concatenate_text_in_region(df, epsilon)
+
+    pd.testing.assert_frame_equal(new, old, check_dtype=False)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_product_borders(seed):
+    rng = np.random.default_rng(seed)
+    n = 40
+    # every word is 10 high, so the borders are top + 10; distinct tops keep the borders distinct
+    tops = rng.permutation(2000)[:n] * 2
+    is_discount = rng.random(n) < 0.3
+    name_info = pd.DataFrame({
+        'conf': 90,
+        'top': tops,
+        'left': 0,
+        'height': 10,
+        'text': np.where(is_discount, 'Allah. 1,00', 'Toode'),
+    })
+    price_tops = rng.permutation(2000)[:n] * 2 + 1
+    price_info = pd.DataFrame({'conf': 90, 'top': price_tops, 'left': 0, 'height': 10, 'text': '1,00'})
+
+    parser = RimiParser.__new__(RimiParser)
+    parser.group_products(name_info, price_info, 5000, filter_prices=False)
+
+    product_borders = pd.concat([
+        pd.DataFrame({'type': 'name', 'y': tops[is_discount] + 10}),
+        pd.DataFrame({'type': 'price', 'y': price_tops + 10}),
+    ], ignore_index=True).sort_values(by='y').drop_duplicates(subset=['type', 'y']).reset_index(drop=True)
+
+    assert parser.new_product_borders == old_product_borders(product_borders, 5000)
@@ -0,0 +1,180 @@
+import os
+import re
+import json
+
+import numpy as np
+
+RULE_TYPES = ('exact', 'prefix', 'regex', 'info')
+
+
+def rule_pattern(rule):
+    pattern = rule['pattern']
+    if rule['type'] == 'exact':
+        return re.escape(pattern) + '$'
+    if rule['type'] == 'prefix':
+        return re.escape(pattern)
+    # regex and info rules match anywhere in the field
+    return f".*?(?:{pattern})"
+
+
+def validate_rule(rule):
+    """
+    Checks a rule on its own and compiles its pattern, raises ValueError when it is invalid.
+    """
+    if not isinstance(rule, dict):
+        raise ValueError("a rule must be an object")
+    if rule.get('type') not in RULE_TYPES:
+        raise ValueError(f"unknown type {rule.get('type')!r}, expected one of {', '.join(RULE_TYPES)}")
+    if not isinstance(rule.get('pattern'), str) or not isinstance(rule.get('category'), str):
+        raise ValueError("pattern and category must be strings")
+    if not isinstance(rule.get('priority', 0), (int, float)):
+        raise ValueError("priority must be a number")
+    try:
+        if rule['type'] in ('regex', 'info'):
+            return re.compile(rule['pattern'], re.IGNORECASE)
+        return re.compile(rule_pattern(rule), re.IGNORECASE)
+    except re.error as e:
+        raise ValueError(f"invalid pattern: {e}") from e
+
+
+class CategoryRules:
+    """
+    Categorization rules, e.g. {"type": "prefix", "pattern": "MAXIMA", "category": "Food - Groceries",
+    "priority": 10, "is_expense": true}. The exact, prefix and regex rules match PARTNER and
+    the info rules are a regex on INFO. is_expense is optional, rules without it apply to both
+    directions, and rules with a higher priority win. Matching is case insensitive.
+    Invalid rules are reported and skipped.
+
+    The rules of each field and direction are compiled into a single alternation regex in
+    priority order with one named group per rule, so one match gives the winning rule.
+    Regex rules with their own groups (their backreferences would point at the wrong group
+    once wrapped) or inline flags can't be part of the alternation, they are matched one by one.
+    """
+    def __init__(self, rules=()):
+        if not isinstance(rules, (list, tuple)):
+            raise ValueError("the rules must be a list")
+        valid_rules = []
+        for i, rule in enumerate(rules):
+            try:
+                valid_rules.append((rule, validate_rule(rule)))
+            except ValueError as e:
+                print(f"Skipping category rule {i} {rule!r}: {e}")
+
+        # stable, so rules with the same priority keep the file order
+        valid_rules.sort(key=lambda item: -item[0].get('priority', 0))
+        self.rules = [rule for rule, _ in valid_rules]
+        self.compiled = [compiled for _, compiled in valid_rules]
+        self.categories = np.array([rule['category'] for rule in self.rules] + ['Uncategorized'], dtype=object)
+        self.no_match = len(self.rules)
+        self.patterns = {}
+        self.separate = {}
+        for field in ('PARTNER', 'INFO'):
+            for is_expense in (True, False):
+                self._compile(field, is_expense)
+
+    def _combinable(self, rank):
+        rule, compiled = self.rules[rank], self.compiled[rank]
+        if rule['type'] not in ('regex', 'info'):
+            return True
+        if compiled.groups:
+            return False
+        try:
+            re.compile(f"(?P<r0>{rule_pattern(rule)})", re.IGNORECASE)
+        except re.error:
+            return False
+        return True
+
+    def _compile(self, field, is_expense):
+        ranks = [
+            rank for rank, rule in enumerate(self.rules)
+            if (rule['type'] == 'info') == (field == 'INFO') and rule.get('is_expense') in (None, is_expense)
+        ]
+        combined = [rank for rank in ranks if self._combinable(rank)]
+        combined_ranks = set(combined)
+        self.separate[(field, is_expense)] = [(rank, self.compiled[rank]) for rank in ranks if rank not in combined_ranks]
+        self.patterns[(field, is_expense)] = None
+        if combined:
+            alternatives = '|'.join(f"(?P<r{rank}>{rule_pattern(self.rules[rank])})" for rank in combined)
+            self.patterns[(field, is_expense)] = re.compile(alternatives, re.IGNORECASE)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def ranks(self, values, field, is_expense):
+        """
+        Rank of the winning rule for each value, self.no_match when no rule matches.
+        """
+        pattern = self.patterns[(field, is_expense)]
+        separate = self.separate[(field, is_expense)]
+        ranks = np.full(len(values), self.no_match, dtype=np.int64)
+        if pattern is None and not separate:
+            return ranks
+        for i, value in enumerate(values):
+            value = str(value)
+            rank = self.no_match
+            if pattern is not None:
+                match = pattern.match(value)
+                if match is not None:
+                    # rules in the alternation have no groups of their own, so the rule group closes last
+                    rank = int(match.lastgroup[1:])
+            # separately matched rules only matter when they rank above the alternation match
+            for separate_rank, compiled in separate:
+                if separate_rank >= rank:
+                    break
+                if compiled.search(value):
+                    rank = separate_rank
+                    break
+            ranks[i] = rank
+        return ranks
+
+    def match(self, partner, is_expense):
+        rank = self.ranks([partner], 'PARTNER', bool(is_expense))[0]
+        return None if rank == self.no_match else self.categories[rank]
+
+    def categorize(self, partners, infos, is_expense):
+        """
+        Categories of the rows from the categorical PARTNER and INFO columns and the is_expense array.
+        Every unique partner and info is matched once, per direction, and the rows take the best
+        rank of the two through the category codes.
+        """
+        rank = np.full(len(is_expense), self.no_match, dtype=np.int64)
+        for field, values in (('PARTNER', partners), ('INFO', infos)):
+            # code -1 (a missing value) picks the trailing no match
+            codes = values.cat.codes.to_numpy()
+            expense_ranks = np.append(self.ranks(values.cat.categories, field, True), self.no_match)
+            income_ranks = np.append(self.ranks(values.cat.categories, field, False), self.no_match)
+            rank = np.minimum(rank, np.where(is_expense, expense_ranks[codes], income_ranks[codes]))
+        return self.categories[rank]
+
+
+class RulesFile:
+    """
+    CategoryRules of a json file, loaded again when the file changes. When the file can't
+    be loaded, the last rules that could are kept.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.rules = CategoryRules()
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            try:
+                self.rules = CategoryRules.load(self.path)
+            except (OSError, ValueError) as e:
+                print(f"Keeping the previous category rules, {self.path} could not be loaded: {e}")
+            self.mtime = mtime
+        return self.rules
+
+    def get_version(self):
+        self.get()
+        return str(self.mtime)
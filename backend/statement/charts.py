@@ -0,0 +1,139 @@
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+
+def statement_fingerprint(df):
+    # Category changes with the mappings, those are part of the cache key separately
+    if 'fingerprint' not in df.attrs:
+        hashes = pd.util.hash_pandas_object(df.drop(columns=['Category'], errors='ignore'), index=False)
+        df.attrs['fingerprint'] = hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()[:16]
+    return df.attrs['fingerprint']
+
+
+def category_distribution_data(df):
+    counts = df['Category'].value_counts()
+    return counts[counts > 0]
+
+def monthly_trend_data(df):
+    return df.groupby(df['Date'].dt.to_period('M'))['SUM'].sum()
+
+def weekday_spending_data(df):
+    return df[df['SUM'] < 0].groupby(df['Date'].dt.dayofweek)['SUM'].mean()
+
+
+def render_category_distribution(data, ax):
+    data.plot(kind='pie', ax=ax)
+    ax.set_title('Transactions by Category')
+
+def render_monthly_trend(data, ax):
+    data.plot(kind='line', ax=ax)
+    ax.set_title('Monthly Spending Trend')
+
+def render_weekday_spending(data, ax):
+    data.plot(kind='bar', ax=ax)
+    ax.set_title('Average Spending by Weekday')
+    ax.set_xlabel('Weekday')
+    ax.set_ylabel('Average Spending')
+
+
+# chart type: (data function, render function, figure size)
+CHARTS = {
+    'category_distribution': (category_distribution_data, render_category_distribution, (10, 6)),
+    'monthly_trend': (monthly_trend_data, render_monthly_trend, (12, 6)),
+    'weekday_spending': (weekday_spending_data, render_weekday_spending, (10, 6)),
+}
+
+
+def chart_points(data):
+    """
+    Chart data as json friendly [{label, value}] points, for the clients that draw the charts themselves.
+    """
+    return [{'label': str(label), 'value': float(value)} for label, value in data.items()]
+
+def histogram_data(values):
+    # same bin count as the histogram plots of the partner amounts
+    values = pd.Series(values).dropna()
+    counts, edges = np.histogram(values, bins=max((len(values) + 1) // 2, 1))
+    return {
+        'counts': counts.tolist(),
+        'edges': edges.tolist(),
+        'mean': float(values.mean()) if len(values) else None
+    }
+
+
+def render_chart(chart_type, data):
+    """
+    Renders the chart into png bytes. Uses the object oriented Figure API instead of pyplot,
+    so it doesn't touch the global pyplot state and can run outside the request thread.
+    """
+    _, render, figsize = CHARTS[chart_type]
+    fig = Figure(figsize=figsize)
+    render(data, fig.subplots())
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+class ChartCache:
+    """
+    Rendered charts keyed by (statement fingerprint, mapping version, chart type), the least
+    recently used are dropped above max_entries. Charts are rendered on a single background
+    worker, requests for a chart that is already being rendered wait for the same render.
+    """
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.charts = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def make_etag(key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+
+    def get(self, key):
+        with self.lock:
+            if key in self.charts:
+                self.charts.move_to_end(key)
+                return self.charts[key]
+        return None
+
+    def submit(self, key, chart_type, data):
+        """
+        Starts rendering the chart in the background unless it is cached or already rendering,
+        returns a future of the png bytes.
+        """
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            future = self.executor.submit(self._render, key, chart_type, data)
+            self.pending[key] = future
+            return future
+
+    def _render(self, key, chart_type, data):
+        try:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            png = render_chart(chart_type, data)
+            with self.lock:
+                self.charts[key] = png
+                while len(self.charts) > self.max_entries:
+                    self.charts.popitem(last=False)
+            return png
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def get_or_render(self, key, chart_type, data):
+        png = self.get(key)
+        if png is None:
+            png = self.submit(key, chart_type, data).result()
+        return png
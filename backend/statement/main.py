@@ -1,27 +1,74 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, url_for, Response
 import pandas as pd
-import json
 from flask_cors import CORS
 from categories import categories
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 import io
+import os
 import base64
+import atexit
+from statement_store import StatementStore
+from mapping_store import MappingStore
+from category_rules import RulesFile
+from partner_index import PartnerIndex
+from charts import CHARTS, ChartCache, statement_fingerprint, chart_points, histogram_data
 
 app = Flask(__name__)
 CORS(app)
 
+# preprocessed statements of the uploads, spilled to parquet when above the memory budget
+# and dropped from the disk after STATEMENT_SPILL_HOURS
+statement_spill_dir = os.getenv('STATEMENT_SPILL_DIR', './data/statements')
+statements = StatementStore(
+    max_bytes=int(os.getenv('STATEMENT_CACHE_MB', 256)) * 1024 * 1024,
+    spill_dir=statement_spill_dir or None,
+    max_spill_age=float(os.getenv('STATEMENT_SPILL_HOURS', 24)) * 3600
+)
+
+charts = ChartCache(max_entries=int(os.getenv('CHART_CACHE_ENTRIES', 128)))
+
+def get_upload_id():
+    # the upload id comes from the X-Upload-Id header, the query string or the json body
+    upload_id = request.headers.get('X-Upload-Id') or request.args.get('upload_id')
+    if upload_id is None and request.is_json:
+        upload_id = (request.get_json(silent=True) or {}).get('upload_id')
+    return upload_id
+
+def wants_chart_data():
+    # ?charts=data returns the aggregated chart series instead of images
+    return request.args.get('charts') == 'data'
+
+def get_statement():
+    upload_id = get_upload_id()
+    df = statements.get(upload_id) if upload_id else None
+    return upload_id, df
+
 
 # Load and preprocess the CSV file
-def map_category(row):
-    partner = row['PARTNER']
-    is_expense = row['is_expense']
-    if is_expense:
-        return expense_mapping.get(partner, 'Uncategorized')
-    else:
-        return income_mapping.get(partner, 'Uncategorized')
-        
+def map_category(df):
+    # the mappings are looked up once per unique partner and taken to the rows by the category codes,
+    # they act as exact rules above all the rules of the rules file
+    expense_mapping, income_mapping = mappings.get()
+    partners = df['PARTNER'].astype('category')
+    unique_partners = pd.Series(partners.cat.categories)
+    codes = partners.cat.codes.to_numpy()
+
+    # code -1 (a missing partner) picks the trailing NaN
+    expense_categories = np.append(unique_partners.map(expense_mapping).to_numpy(dtype=object), np.nan)
+    income_categories = np.append(unique_partners.map(income_mapping).to_numpy(dtype=object), np.nan)
+
+    # NaN counts as an expense, like it did in `if is_expense`
+    is_expense = df['is_expense'].astype(bool).to_numpy()
+    category = np.where(is_expense, expense_categories[codes], income_categories[codes])
+
+    unmapped = pd.isna(category)
+    if unmapped.any():
+        rule_categories = rules.get().categorize(partners[unmapped], df['INFO'][unmapped].astype('category'), is_expense[unmapped])
+        category[unmapped] = rule_categories
+    return pd.Series(category, index=df.index).astype('category')
+
 def preprocess_data(df):
     df = df.drop(columns=['Transfer reference', 'Document number', 'Unnamed: 12', 'Row type','Reference number','Client account'])
 
@@ -32,8 +79,9 @@ def preprocess_data(df):
 
     df['Debit/Credit'] = df['Debit/Credit'].map({'K': False, 'D': True})
     df = df.rename(columns={'Debit/Credit':'is_expense', 'Details': 'INFO','Beneficiary/Payer':'PARTNER', 'Amount':'SUM'})
+    df['PARTNER'] = df['PARTNER'].astype('category')
 
-    df['Category'] = df.apply(map_category, axis=1)
+    df['Category'] = map_category(df)
 
     # preprocessing
     df_extra = df[df['Transaction type'].isin(['LS','AS','K2','M'])].copy()
@@ -45,50 +93,59 @@ def preprocess_data(df):
 
     return df_main
 
-# Load mapping tables
-def load_mapping_tables():
-    try:
-        with open('./data/expense_mapping.json', 'r') as f:
-            expense_mapping = json.load(f)
-    except FileNotFoundError:
-        expense_mapping = {}
+# mapping tables, kept in memory and compacted to ./data/*_mapping.json
+mappings = MappingStore('./data', compact_every=int(os.getenv('MAPPING_COMPACT_EVERY', 100)))
+atexit.register(mappings.flush)
+
+# exact, prefix, regex and INFO rules for the partners without a mapping
+rules = RulesFile(os.getenv('CATEGORY_RULES_PATH', './data/category_rules.json'))
 
-    try:
-        with open('./data/income_mapping.json', 'r') as f:
-            income_mapping = json.load(f)
-    except FileNotFoundError:
-        income_mapping = {}
+def get_mapping_version():
+    return f"{mappings.get_version()}-{rules.get_version()}"
 
-    return expense_mapping, income_mapping
+def refresh_categories(df):
+    # Category only changes with the mappings and rules, the version it was mapped with is kept on the statement
+    mapping_version = get_mapping_version()
+    if df.attrs.get('mapping_version') != mapping_version or 'Category' not in df:
+        df['Category'] = map_category(df)
+        df.attrs['mapping_version'] = mapping_version
+    return mapping_version
 
-expense_mapping, income_mapping = load_mapping_tables()
+def chart_key(df, mapping_version, chart_type):
+    return (statement_fingerprint(df), mapping_version, chart_type)
 
 @app.route('/get_next_partners', methods=['GET'])
 def get_next_partners():
+    upload_id, df = get_statement()
+    if df is None:
+        return jsonify({'error': 'Unknown upload id, upload the statement again'}), 404
+    partner_index = statements.get_derived(upload_id, 'partner_index', PartnerIndex)
+
+    expense_mapping, income_mapping = mappings.get()
     total_partners = df['PARTNER'].nunique()
     categorized_partners = len(set(expense_mapping.keys()) | set(income_mapping.keys()))
-    
-    # Group by partner and transaction type, calculate total absolute sum
-    partner_sums = df.groupby(['PARTNER', 'is_expense'])['SUM'].sum().abs().reset_index()
-    partner_sums = partner_sums.sort_values('SUM', ascending=False)
+    progress = f"{categorized_partners}/{total_partners}"
 
+    category_rules = rules.get()
+
+    def is_categorized(partner, is_expense):
+        if partner in (expense_mapping if is_expense else income_mapping):
+            return True
+        return category_rules.match(partner, is_expense) is not None
+
+    # Pre-load 10 partners with the largest total absolute sum
     next_partners = []
-    for _, row in partner_sums.iterrows():
-        partner = row['PARTNER']
-        is_expense = row['is_expense']
-        
-        if (is_expense and partner not in expense_mapping) or (not is_expense and partner not in income_mapping):
-            partner_info = create_partner_info(df[df['PARTNER'] == partner].iloc[0], is_expense, categorized_partners, total_partners)
-            next_partners.append(partner_info)
-            
-        if len(next_partners) == 10:  # Pre-load 10 partners
-            break
+    for partner, is_expense in partner_index.next_partners(is_categorized, limit=10):
+        entry = partner_index.entries[(partner, is_expense)]
+        next_partners.append(create_partner_info(
+            partner, is_expense, partner_index.amounts_of((partner, is_expense)),
+            entry['count'], entry['info'], progress, wants_chart_data()
+        ))
     
     return jsonify(next_partners)
 
 @app.route('/upload_statement', methods=['POST'])
 def upload_statement():
-    global df
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
@@ -99,23 +156,28 @@ def upload_statement():
     if file and file.filename.endswith('.csv'):
         df = pd.read_csv(file, sep=';')
         df = preprocess_data(df)
-        insights = generate_insights(df)
+        upload_id = statements.add(df)
+        insights = generate_insights(df, upload_id, wants_chart_data())
+        insights['upload_id'] = upload_id
         return jsonify(insights)
     
     return jsonify({'error': 'Invalid file format'}), 400
 
 @app.route('/get_insights', methods=['GET'])
 def get_insights():
-    insights = generate_insights(df)
-    return jsonify(insights)
+    upload_id, df = get_statement()
+    if df is None:
+        return jsonify({'error': 'Unknown upload id, upload the statement again'}), 404
 
-def generate_insights(df):
-    global expense_mapping, income_mapping
-    expense_mapping, income_mapping = load_mapping_tables()
+    insights = generate_insights(df, upload_id, wants_chart_data())
+    insights['upload_id'] = upload_id
+    return jsonify(insights)
 
-    df['Category'] = df.apply(map_category, axis=1)
+def generate_insights(df, upload_id, chart_data_only=False):
+    mapping_version = refresh_categories(df)
+    df['Date'] = pd.to_datetime(df['Date'])
 
-    # Calculate various statistics and generate plots
+    # Calculate various statistics
     total_transactions = len(df)
     total_income = df[df['SUM'] > 0]['SUM'].sum()
     total_expenses = abs(df[df['SUM'] < 0]['SUM'].sum())
@@ -126,39 +188,19 @@ def generate_insights(df):
     expense_ratio = total_expenses / total_income if total_income > 0 else 0
     
     # Top 5 expense categories
-    top_expense_categories = df[df['SUM'] < 0].groupby('Category')['SUM'].sum().sort_values().head().to_dict()
-    
-    # Generate category distribution plot
-    plt.figure(figsize=(10, 6))
-    df['Category'].value_counts().plot(kind='pie')
-    plt.title('Transactions by Category')
-    category_distribution = plot_to_base64(plt)
-    
-    # Generate monthly spending trend plot
-    df['Date'] = pd.to_datetime(df['Date'])
-    monthly_trend = df.groupby(df['Date'].dt.to_period('M'))['SUM'].sum()
-    plt.figure(figsize=(12, 6))
-    monthly_trend.plot(kind='line')
-    plt.title('Monthly Spending Trend')
-    monthly_trend_plot = plot_to_base64(plt)
-    
-    # Generate average spending by weekday plot
-    weekday_spending = df[df['SUM'] < 0].groupby(df['Date'].dt.dayofweek)['SUM'].mean()
-    plt.figure(figsize=(10, 6))
-    weekday_spending.plot(kind='bar')
-    plt.title('Average Spending by Weekday')
-    plt.xlabel('Weekday')
-    plt.ylabel('Average Spending')
-    weekday_spending_plot = plot_to_base64(plt)
-    
-    # # Generate average spending by hour plot
-    # hourly_spending = df[df['SUM'] < 0].groupby(df['Date'].dt.hour)['SUM'].mean()
-    # plt.figure(figsize=(12, 6))
-    # hourly_spending.plot(kind='line')
-    # plt.title('Average Spending by Hour')
-    # plt.xlabel('Hour of Day')
-    # plt.ylabel('Average Spending')
-    # hourly_spending_plot = plot_to_base64(plt)
+    top_expense_categories = df[df['SUM'] < 0].groupby('Category', observed=True)['SUM'].sum().sort_values().head().to_dict()
+
+    # charts are served by /chart, missing ones start rendering in the background right away,
+    # in the chart data mode the client draws them from the aggregated series
+    chart_urls = {}
+    for chart_type, (chart_data, _, _) in CHARTS.items():
+        if chart_data_only:
+            chart_urls[chart_type] = chart_points(chart_data(df))
+            continue
+        key = chart_key(df, mapping_version, chart_type)
+        if charts.get(key) is None:
+            charts.submit(key, chart_type, chart_data(df))
+        chart_urls[chart_type] = url_for('get_chart', upload_id=upload_id, chart_type=chart_type, v=charts.make_etag(key), _external=True)
     
     return {
         'total_transactions': total_transactions,
@@ -170,26 +212,48 @@ def generate_insights(df):
         'largest_income': largest_income,
         'expense_ratio': expense_ratio,
         'top_expense_categories': [{'name': k, 'amount': v} for k, v in top_expense_categories.items()],
-        'category_distribution': category_distribution,
-        'monthly_trend': monthly_trend_plot,
-        'weekday_spending': weekday_spending_plot,
-        # 'hourly_spending': hourly_spending_plot
+        'category_distribution': chart_urls['category_distribution'],
+        'monthly_trend': chart_urls['monthly_trend'],
+        'weekday_spending': chart_urls['weekday_spending'],
     }
 
-def plot_to_base64(plt):
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png')
-    buffer.seek(0)
-    image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    plt.close()
-    return image_base64
-
-def create_partner_info(row, is_expense, categorized_partners, total_partners):
-    partner = row['PARTNER']
-    partner_df = df[(df['PARTNER'] == partner) & (df['is_expense'] == is_expense)]
-    
+@app.route('/chart/<upload_id>/<chart_type>', methods=['GET'])
+def get_chart(upload_id, chart_type):
+    if chart_type not in CHARTS:
+        return jsonify({'error': 'Unknown chart'}), 404
+    df = statements.get(upload_id)
+    if df is None:
+        return jsonify({'error': 'Unknown upload id, upload the statement again'}), 404
+
+    key = chart_key(df, refresh_categories(df), chart_type)
+    etag = charts.make_etag(key)
+    if etag in request.if_none_match:
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    png = charts.get(key)
+    if png is None:
+        chart_data = CHARTS[chart_type][0]
+        png = charts.get_or_render(key, chart_type, chart_data(df))
+
+    response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def create_partner_info(partner, is_expense, amounts, transaction_count, most_popular_info, progress, chart_data_only=False):
     # Filter out NaN values from the 'SUM' column
-    sum_data = partner_df['SUM'].dropna()
+    sum_data = pd.Series(amounts).dropna()
+    partner_info = {
+        "partner": partner,
+        "transaction_count": transaction_count,
+        "is_expense": bool(is_expense),
+        "most_popular_info": most_popular_info,
+        "progress": progress
+    }
+
+    if chart_data_only:
+        partner_info["price_distribution"] = histogram_data(sum_data)
+        return partner_info
 
     # Calculate the optimal number of bins for the histogram
     num_bins = (sum_data.shape[0]+1)//2
@@ -222,14 +286,8 @@ def create_partner_info(row, is_expense, categorized_partners, total_partners):
     plot_data = base64.b64encode(buffer.getvalue()).decode()
     plt.close()
 
-    return {
-        "partner": partner,
-        "transaction_count": len(partner_df),
-        "is_expense": is_expense,
-        "most_popular_info": partner_df['INFO'].mode().iloc[0],
-        "progress": f"{categorized_partners}/{total_partners}",
-        "price_distribution": plot_data
-    }
+    partner_info["price_distribution"] = plot_data
+    return partner_info
 
 @app.route('/categorize', methods=['POST'])
 def categorize():
@@ -239,17 +297,20 @@ def categorize():
     subcategory = data['subcategory']
     is_expense = data['is_expense']
 
-    if is_expense:
-        expense_mapping[partner] = f"{category} - {subcategory}"
-        with open('./data/expense_mapping.json', 'w') as f:
-            json.dump(expense_mapping, f)
-    else:
-        income_mapping[partner] = f"{category} - {subcategory}"
-        with open('./data/income_mapping.json', 'w') as f:
-            json.dump(income_mapping, f)
+    # keeps the partner index of the upload up to date, the mappings below cover the other uploads
+    partner_index = statements.get_derived(data['upload_id'], 'partner_index', PartnerIndex) if data.get('upload_id') else None
+    if partner_index is not None:
+        partner_index.categorize(partner, is_expense)
+
+    mappings.set(partner, f"{category} - {subcategory}", is_expense)
 
     return jsonify({"message": "Categorization saved successfully"})
 
+@app.route('/save_mapping', methods=['POST'])
+def save_mapping():
+    mappings.flush()
+    return jsonify({"message": "Mapping tables saved successfully"})
+
 @app.route('/get_categories', methods=['GET'])
 def get_categories():
     return jsonify(categories)
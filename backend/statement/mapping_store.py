@@ -0,0 +1,85 @@
+import os
+import json
+import uuid
+import threading
+
+
+class MappingStore:
+    """
+    Partner to category mappings served from memory. Every change is appended to a jsonl log
+    and the log is compacted into expense_mapping.json / income_mapping.json every
+    compact_every changes (or on flush), by writing a temp file and renaming it over the old one.
+    The dicts are copied on write, so readers can use the ones returned by get() without locking.
+    """
+    def __init__(self, data_dir='./data', compact_every=100):
+        self.data_dir = data_dir
+        self.compact_every = compact_every
+        self.paths = {
+            True: os.path.join(data_dir, 'expense_mapping.json'),
+            False: os.path.join(data_dir, 'income_mapping.json'),
+        }
+        self.log_path = os.path.join(data_dir, 'mapping_log.jsonl')
+        self.lock = threading.Lock()
+        # the version is only comparable within one process, hence the random instance id
+        self.instance = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.pending = 0
+        self.mappings = {is_expense: self._read(path) for is_expense, path in self.paths.items()}
+        self._replay()
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _replay(self):
+        # changes that were logged but not compacted yet, e.g. after a crash
+        try:
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a partially written last line
+                        continue
+                    self.mappings[change['is_expense']][change['partner']] = change['category']
+                    self.pending += 1
+        except FileNotFoundError:
+            pass
+
+    def get(self):
+        return self.mappings[True], self.mappings[False]
+
+    def get_version(self):
+        return f"{self.instance}-{self.version}"
+
+    def set(self, partner, category, is_expense):
+        is_expense = bool(is_expense)
+        with self.lock:
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps({'partner': partner, 'category': category, 'is_expense': is_expense}) + '\n')
+            self.mappings[is_expense] = {**self.mappings[is_expense], partner: category}
+            self.version += 1
+            self.pending += 1
+            if self.pending >= self.compact_every:
+                self._compact()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self._compact()
+
+    def _compact(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        for is_expense, path in self.paths.items():
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.mappings[is_expense], f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        # replaying the log again is harmless, so it is only truncated after both files are in place
+        open(self.log_path, 'w').close()
+        self.pending = 0
@@ -0,0 +1,62 @@
+import threading
+
+import numpy as np
+
+
+class PartnerIndex:
+    """
+    Per statement aggregates of every (partner, is_expense) group: row positions, SUM total,
+    transaction count and the most common INFO, ordered by the absolute SUM total.
+    Built once per upload, so the categorizer doesn't scan the statement for every partner.
+    """
+    def __init__(self, df):
+        groups = df.groupby(['PARTNER', 'is_expense'], observed=True, sort=False)
+        sums = groups['SUM'].sum()
+        counts = groups.size()
+
+        # the most common INFO of every group, ties go to the smallest like Series.mode
+        info_counts = df.groupby(['PARTNER', 'is_expense', 'INFO'], observed=True).size().reset_index(name='count')
+        info_counts = info_counts.sort_values(['count', 'INFO'], ascending=[False, True], kind='mergesort')
+        modes = info_counts.drop_duplicates(['PARTNER', 'is_expense']).set_index(['PARTNER', 'is_expense'])['INFO']
+
+        self.amounts = df['SUM'].to_numpy()
+        self.positions = groups.indices
+        self.entries = {
+            key: {'sum': sums[key], 'count': int(counts[key]), 'info': modes.get(key)}
+            for key in self.positions
+        }
+        order = np.argsort(-sums.abs().to_numpy(), kind='mergesort')
+        self.order = [sums.index[i] for i in order]
+
+        # everything before the cursor is categorized already
+        self.cursor = 0
+        self.categorized = set()
+        self.lock = threading.Lock()
+
+    def amounts_of(self, key):
+        return self.amounts[self.positions[key]]
+
+    def categorize(self, partner, is_expense):
+        with self.lock:
+            self.categorized.add((partner, is_expense))
+
+    def next_partners(self, is_categorized, limit=10):
+        """
+        Returns up to `limit` uncategorized (partner, is_expense) keys with the largest absolute totals.
+        is_categorized(partner, is_expense) is checked as well, as the mappings are shared by all uploads.
+        """
+        with self.lock:
+            def done(key):
+                return key in self.categorized or is_categorized(*key)
+
+            # mappings only grow, so the categorized keys at the start are never looked at again
+            while self.cursor < len(self.order) and done(self.order[self.cursor]):
+                self.cursor += 1
+
+            keys = []
+            for key in self.order[self.cursor:]:
+                if len(keys) == limit:
+                    break
+                if not done(key):
+                    keys.append(key)
+            return keys
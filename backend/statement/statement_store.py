@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class StatementStore:
+    """
+    Preprocessed statements keyed by upload id. The least recently used statements are
+    evicted when the total memory use goes above max_bytes, and spilled to parquet files
+    in spill_dir (when given) so they can be loaded again on the next request.
+    Spilled files older than max_spill_age seconds are removed whenever another statement is
+    spilled, and the files of a previous process are removed on start.
+    Data derived from a statement, like its partner index, is kept until the statement is evicted.
+    """
+    def __init__(self, max_bytes, spill_dir=None, max_spill_age=24 * 3600):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_age = max_spill_age
+        self.statements = OrderedDict()
+        self.sizes = {}
+        self.derived = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self._purge_spills()
+
+    def add(self, df):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self._put(upload_id, df)
+        return upload_id
+
+    def get(self, upload_id):
+        with self.lock:
+            if upload_id in self.statements:
+                self.statements.move_to_end(upload_id)
+                return self.statements[upload_id]
+
+            path = self._spill_path(upload_id)
+            if path is None or not os.path.exists(path):
+                return None
+            df = pd.read_parquet(path)
+            os.remove(path)
+            self._put(upload_id, df)
+            return df
+
+    def get_derived(self, upload_id, name, build):
+        """
+        Returns build(df) of the statement, built once and cached until the statement is evicted.
+        """
+        df = self.get(upload_id)
+        if df is None:
+            return None
+        with self.lock:
+            if name in self.derived.get(upload_id, {}):
+                return self.derived[upload_id][name]
+        value = build(df)
+        with self.lock:
+            if upload_id in self.statements:
+                value = self.derived.setdefault(upload_id, {}).setdefault(name, value)
+        return value
+
+    def _spill_path(self, upload_id):
+        # upload ids come from the client, only ids made by add() map to a file
+        if self.spill_dir is None or not upload_id or not upload_id.isalnum():
+            return None
+        return os.path.join(self.spill_dir, f"{upload_id}.parquet")
+
+    def _put(self, upload_id, df):
+        size = int(df.memory_usage(deep=True).sum())
+        self.statements[upload_id] = df
+        self.sizes[upload_id] = size
+        self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        # the most recently used statement always stays, even when it alone is above the budget
+        while self.total_bytes > self.max_bytes and len(self.statements) > 1:
+            upload_id, df = self.statements.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(upload_id)
+            self.derived.pop(upload_id, None)
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                path = self._spill_path(upload_id)
+                df.to_parquet(path + '.tmp', index=False)
+                os.replace(path + '.tmp', path)
+                self._purge_spills(self.max_spill_age)
+
+    def _purge_spills(self, max_age=None):
+        # removes the spilled files older than max_age seconds, all of them when it is None
+        if self.spill_dir is None or not os.path.isdir(self.spill_dir):
+            return
+        oldest = None if max_age is None else time.time() - max_age
+        for name in os.listdir(self.spill_dir):
+            if not (name.endswith('.parquet') or name.endswith('.parquet.tmp')):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if oldest is None or os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,146 @@
+"""
+The vectorized categorization against the row by row implementations: the mapping lookup
+map_category did with df.apply, and the rules checked one at a time in priority order.
+"""
+import re
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+from category_rules import CategoryRules
+
+PARTNERS = ['MAXIMA EESTI OU', 'Maxima X123', 'RIMI EESTI FOOD AS', 'Bolt Operations OU', 'BOLT FOOD',
+            'John Smith', 'john smith', 'ELISA EESTI AS', 'Apotheka', 'aa-aa', 'Wolt']
+INFOS = ['Palk', 'salary 2024', 'kaardimakse', 'Tagastus', 'rent for May', None]
+
+RULES = [
+    {"type": "exact", "pattern": "john smith", "category": "Transfers", "priority": 5},
+    {"type": "prefix", "pattern": "MAXIMA", "category": "Food - Groceries", "priority": 10, "is_expense": True},
+    {"type": "prefix", "pattern": "bolt", "category": "Transport - Taxi", "priority": 10},
+    {"type": "regex", "pattern": "bolt food|wolt", "category": "Food - Delivery", "priority": 20, "is_expense": True},
+    {"type": "regex", "pattern": r"(\w)\1-\1\1", "category": "Other - Repeated", "priority": 30},
+    {"type": "regex", "pattern": "(?i)eesti", "category": "Other - Estonian", "priority": 1},
+    {"type": "info", "pattern": "palk|salary", "category": "Income - Salary", "priority": 50, "is_expense": False},
+    {"type": "info", "pattern": "rent", "category": "Housing - Rent", "priority": 10},
+    {"type": "regex", "pattern": "(", "category": "Broken", "priority": 100},
+]
+
+
+def rule_matches(rule, value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return False
+    if rule['type'] == 'exact':
+        return value.lower() == rule['pattern'].lower()
+    if rule['type'] == 'prefix':
+        return value.lower().startswith(rule['pattern'].lower())
+    return re.search(rule['pattern'], value, re.IGNORECASE) is not None
+
+
+def old_categorize(rules, partner, info, is_expense):
+    valid = []
+    for rule in rules:
+        try:
+            re.compile(rule['pattern'])
+        except re.error:
+            continue
+        valid.append(rule)
+    for rule in sorted(valid, key=lambda rule: -rule.get('priority', 0)):
+        if rule.get('is_expense') not in (None, is_expense):
+            continue
+        value = info if rule['type'] == 'info' else partner
+        if rule_matches(rule, value):
+            return rule['category']
+    return 'Uncategorized'
+
+
+def random_statement(seed, n=300):
+    rng = np.random.default_rng(seed)
+    partners = np.array(PARTNERS + [None], dtype=object)[rng.integers(0, len(PARTNERS) + 1, n)]
+    infos = np.array(INFOS, dtype=object)[rng.integers(0, len(INFOS), n)]
+    return pd.DataFrame({
+        'PARTNER': partners,
+        'INFO': infos,
+        'is_expense': rng.random(n) < 0.6,
+    })
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_categorize_matches_rules_one_by_one(seed):
+    df = random_statement(seed)
+    rules = CategoryRules(RULES)
+
+    new = rules.categorize(df['PARTNER'].astype('category'), df['INFO'].astype('category'), df['is_expense'].to_numpy())
+    old = [old_categorize(RULES, row.PARTNER, row.INFO, row.is_expense) for row in df.itertuples()]
+
+    assert list(new) == old
+
+
+@pytest.fixture(scope='module')
+def main(tmp_path_factory):
+    for module in ("flask", "flask_cors", "matplotlib", "seaborn"):
+        pytest.importorskip(module)
+    with pytest.MonkeyPatch.context() as mp:
+        # keep the module level stores away from the data directory of the app
+        mp.chdir(tmp_path_factory.mktemp('statement'))
+        mp.setenv('STATEMENT_SPILL_DIR', '')
+        mp.setenv('MPLBACKEND', 'Agg')
+        import main
+        yield main
+
+
+class FixedMappings:
+    def __init__(self, expense_mapping, income_mapping):
+        self.mappings = (expense_mapping, income_mapping)
+
+    def get(self):
+        return self.mappings
+
+
+class FixedRules:
+    def __init__(self, rules=()):
+        self.rules = CategoryRules(list(rules))
+
+    def get(self):
+        return self.rules
+
+
+def old_map_category(row, expense_mapping, income_mapping):
+    if row['is_expense']:
+        return expense_mapping.get(row['PARTNER'], 'Uncategorized')
+    return income_mapping.get(row['PARTNER'], 'Uncategorized')
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_map_category_matches_the_row_by_row_mapping(main, monkeypatch, seed):
+    expense_mapping = {'MAXIMA EESTI OU': 'Food - Groceries', 'BOLT FOOD': 'Food - Delivery', 'John Smith': 'Transfers'}
+    income_mapping = {'John Smith': 'Income - Transfers', 'ELISA EESTI AS': 'Income - Refunds'}
+    monkeypatch.setattr(main, 'mappings', FixedMappings(expense_mapping, income_mapping))
+    monkeypatch.setattr(main, 'rules', FixedRules())
+    df = random_statement(seed)
+    # a missing is_expense counted as an expense in the old `if is_expense`
+    df['is_expense'] = df['is_expense'].astype(object)
+    df.loc[df.index[::17], 'is_expense'] = np.nan
+
+    new = main.map_category(df)
+    old = df.apply(old_map_category, axis=1, args=(expense_mapping, income_mapping))
+
+    assert new.dtype == 'category'
+    assert new.astype(object).tolist() == old.tolist()
+
+
+def test_map_category_uses_the_rules_for_unmapped_partners(main, monkeypatch):
+    expense_mapping = {'MAXIMA EESTI OU': 'Food - Other'}
+    monkeypatch.setattr(main, 'mappings', FixedMappings(expense_mapping, {}))
+    monkeypatch.setattr(main, 'rules', FixedRules(RULES))
+    df = random_statement(0)
+
+    new = main.map_category(df)
+    old = [
+        expense_mapping[row.PARTNER] if row.is_expense and row.PARTNER in expense_mapping
+        else old_categorize(RULES, row.PARTNER, row.INFO, row.is_expense)
+        for row in df.itertuples()
+    ]
+
+    assert new.astype(object).tolist() == old
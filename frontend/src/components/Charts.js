@@ -0,0 +1,142 @@
+import React from 'react';
+
+// Small SVG charts drawn from the aggregated series of the statement API (?charts=data)
+
+const COLORS = ['#4e79a7', '#f28e2b', '#e15759', '#76b7b2', '#59a14f', '#edc948', '#b07aa1', '#ff9da7', '#9c755f', '#bab0ac'];
+const WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'];
+
+const WIDTH = 600;
+const HEIGHT = 300;
+const PADDING = 40;
+
+function scale(value, min, max, from, to) {
+  if (max === min) return (from + to) / 2;
+  return from + ((value - min) / (max - min)) * (to - from);
+}
+
+export function PieChart({ points }) {
+  const total = points.reduce((sum, point) => sum + point.value, 0);
+  const radius = HEIGHT / 2 - PADDING / 2;
+  const cx = HEIGHT / 2;
+  const cy = HEIGHT / 2;
+  let angle = -Math.PI / 2;
+
+  return (
+    <svg viewBox={`0 0 ${WIDTH} ${HEIGHT}`} width="100%">
+      {points.map((point, index) => {
+        const sweep = total > 0 ? (point.value / total) * 2 * Math.PI : 0;
+        const start = angle;
+        angle += sweep;
+        const largeArc = sweep > Math.PI ? 1 : 0;
+        const x1 = cx + radius * Math.cos(start);
+        const y1 = cy + radius * Math.sin(start);
+        const x2 = cx + radius * Math.cos(angle);
+        const y2 = cy + radius * Math.sin(angle);
+        const color = COLORS[index % COLORS.length];
+        const path = sweep >= 2 * Math.PI - 1e-9
+          ? <circle cx={cx} cy={cy} r={radius} fill={color} />
+          : <path d={`M ${cx} ${cy} L ${x1} ${y1} A ${radius} ${radius} 0 ${largeArc} 1 ${x2} ${y2} Z`} fill={color} />;
+        return (
+          <g key={point.label}>
+            {path}
+            <rect x={HEIGHT + 10} y={10 + index * 18} width={12} height={12} fill={color} />
+            <text x={HEIGHT + 28} y={21 + index * 18} fontSize="12" fill="currentColor">{point.label} ({point.value})</text>
+          </g>
+        );
+      })}
+    </svg>
+  );
+}
+
+export function LineChart({ points }) {
+  const values = points.map((point) => point.value);
+  const min = Math.min(0, ...values);
+  const max = Math.max(0, ...values);
+  const x = (index) => scale(index, 0, points.length - 1, PADDING, WIDTH - PADDING);
+  const y = (value) => scale(value, min, max, HEIGHT - PADDING, PADDING);
+  const line = points.map((point, index) => `${index === 0 ? 'M' : 'L'} ${x(index)} ${y(point.value)}`).join(' ');
+  const labelEvery = Math.max(1, Math.ceil(points.length / 12));
+
+  return (
+    <svg viewBox={`0 0 ${WIDTH} ${HEIGHT}`} width="100%">
+      <line x1={PADDING} x2={WIDTH - PADDING} y1={y(0)} y2={y(0)} stroke="#999" />
+      <path d={line} fill="none" stroke={COLORS[0]} strokeWidth="2" />
+      {points.map((point, index) => (
+        <g key={point.label}>
+          <circle cx={x(index)} cy={y(point.value)} r="3" fill={COLORS[0]}>
+            <title>{`${point.label}: ${point.value.toFixed(2)}`}</title>
+          </circle>
+          {index % labelEvery === 0 && (
+            <text x={x(index)} y={HEIGHT - PADDING / 3} fontSize="10" textAnchor="middle" fill="currentColor">{point.label}</text>
+          )}
+        </g>
+      ))}
+    </svg>
+  );
+}
+
+export function BarChart({ points, labels }) {
+  const values = points.map((point) => point.value);
+  const min = Math.min(0, ...values);
+  const max = Math.max(0, ...values);
+  const y = (value) => scale(value, min, max, HEIGHT - PADDING, PADDING);
+  const barWidth = (WIDTH - 2 * PADDING) / Math.max(points.length, 1);
+
+  return (
+    <svg viewBox={`0 0 ${WIDTH} ${HEIGHT}`} width="100%">
+      {points.map((point, index) => (
+        <g key={point.label}>
+          <rect
+            x={PADDING + index * barWidth + barWidth * 0.1}
+            y={Math.min(y(point.value), y(0))}
+            width={barWidth * 0.8}
+            height={Math.abs(y(point.value) - y(0))}
+            fill={COLORS[0]}
+          >
+            <title>{`${point.value.toFixed(2)}`}</title>
+          </rect>
+          <text x={PADDING + (index + 0.5) * barWidth} y={HEIGHT - PADDING / 3} fontSize="12" textAnchor="middle" fill="currentColor">
+            {labels ? labels[Number(point.label)] ?? point.label : point.label}
+          </text>
+        </g>
+      ))}
+      <line x1={PADDING} x2={WIDTH - PADDING} y1={y(0)} y2={y(0)} stroke="#999" />
+    </svg>
+  );
+}
+
+export function WeekdayChart({ points }) {
+  return <BarChart points={points} labels={WEEKDAYS} />;
+}
+
+export function Histogram({ histogram }) {
+  const { counts, edges, mean } = histogram;
+  const maxCount = Math.max(1, ...counts);
+  const x = (value) => scale(value, edges[0], edges[edges.length - 1], PADDING, WIDTH - PADDING);
+  const y = (count) => scale(count, 0, maxCount, HEIGHT - PADDING, PADDING);
+
+  return (
+    <svg viewBox={`0 0 ${WIDTH} ${HEIGHT}`} width="100%">
+      {counts.map((count, index) => (
+        <rect
+          key={index}
+          x={x(edges[index])}
+          y={y(count)}
+          width={Math.max(1, x(edges[index + 1]) - x(edges[index]) - 1)}
+          height={HEIGHT - PADDING - y(count)}
+          fill="skyblue"
+        >
+          <title>{`${edges[index].toFixed(2)} – ${edges[index + 1].toFixed(2)}: ${count}`}</title>
+        </rect>
+      ))}
+      {mean !== null && (
+        <g>
+          <line x1={x(mean)} x2={x(mean)} y1={PADDING} y2={HEIGHT - PADDING} stroke="red" strokeDasharray="6 4" strokeWidth="2" />
+          <text x={x(mean) + 4} y={PADDING + 12} fontSize="12" fill="red" fontWeight="bold">{mean.toFixed(2)}</text>
+        </g>
+      )}
+      <text x={PADDING} y={HEIGHT - PADDING / 3} fontSize="10" fill="currentColor">{edges[0].toFixed(2)}</text>
+      <text x={WIDTH - PADDING} y={HEIGHT - PADDING / 3} fontSize="10" textAnchor="end" fill="currentColor">{edges[edges.length - 1].toFixed(2)}</text>
+    </svg>
+  );
+}
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
+import { PieChart, LineChart, WeekdayChart } from './Charts';
 import './InsightsPage.css';
 
 function formatNumberWithSpaces(number) {
@@ -20,7 +21,9 @@ function InsightsPage({ onCategorize, statementData, setStatementData }) {
 
   const refreshInsights = async () => {
     try {
-      const response = await axios.get('http://localhost:5000/get_insights');
+      const response = await axios.get('http://localhost:5000/get_insights', {
+        params: { upload_id: statementData.upload_id, charts: 'data' }
+      });
       setStatementData(response.data);
     } catch (error) {
       console.error('Error refreshing insights:', error);
@@ -36,6 +39,7 @@ function InsightsPage({ onCategorize, statementData, setStatementData }) {
 
     try {
       const response = await axios.post('http://localhost:5000/upload_statement', formData, {
+        params: { charts: 'data' },
         headers: { 'Content-Type': 'multipart/form-data' }
       });
       setStatementData(response.data);
@@ -70,7 +74,7 @@ function InsightsPage({ onCategorize, statementData, setStatementData }) {
         </div>
         <div className="pie-chart">
           <h3>Spending by Category</h3>
-          <img src={`data:image/png;base64,${statementData.category_distribution}`} alt="Category Distribution" />
+          <PieChart points={statementData.category_distribution} />
         </div>
       </div>
     );
@@ -83,11 +87,11 @@ function InsightsPage({ onCategorize, statementData, setStatementData }) {
       <div className="insights-grid">
         <div className="insight-card">
           <h3>Monthly Spending Trend</h3>
-          <img src={`data:image/png;base64,${statementData.monthly_trend}`} alt="Monthly Spending Trend" />
+          <LineChart points={statementData.monthly_trend} />
         </div>
         <div className="insight-card">
           <h3>Average Spending by Weekday</h3>
-          <img src={`data:image/png;base64,${statementData.weekday_spending}`} alt="Average Spending by Weekday" />
+          <WeekdayChart points={statementData.weekday_spending} />
         </div>
         {/* <div className="insight-card">
           <h3>Average Spending by Hour</h3>
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
+import { Histogram } from './Charts';
 
 function TransactionCategorizer({ onBack, statementData, setStatementData }) {
   const [partners, setPartners] = useState([]);
@@ -15,7 +16,9 @@ function TransactionCategorizer({ onBack, statementData, setStatementData }) {
 
   const getNextPartners = async () => {
     try {
-      const response = await axios.get('http://localhost:5000/get_next_partners');
+      const response = await axios.get('http://localhost:5000/get_next_partners', {
+        params: { upload_id: statementData.upload_id, charts: 'data' }
+      });
       setPartners(response.data);
       setCurrentPartnerIndex(0);
       setLoading(false);
@@ -41,7 +44,8 @@ function TransactionCategorizer({ onBack, statementData, setStatementData }) {
         partner: partner.partner,
         category: category,
         subcategory: subcategory || category,
-        is_expense: partner.is_expense
+        is_expense: partner.is_expense,
+        upload_id: statementData.upload_id
       });
       setSelectedCategory(null);
       
@@ -49,16 +53,28 @@ function TransactionCategorizer({ onBack, statementData, setStatementData }) {
         setCurrentPartnerIndex(currentPartnerIndex + 1);
       } else {
         setLoading(true);
+        // Save mapping table after each batch of partners
+        await saveMapping();
         getNextPartners();
       }
-  
-      // Save mapping table after each categorization
-      await axios.post('http://localhost:5000/save_mapping');
     } catch (error) {
       console.error('Error categorizing partner:', error);
     }
   };
 
+  const saveMapping = async () => {
+    try {
+      await axios.post('http://localhost:5000/save_mapping');
+    } catch (error) {
+      console.error('Error saving mapping:', error);
+    }
+  };
+
+  const handleBack = async () => {
+    await saveMapping();
+    onBack();
+  };
+
   if (loading) {
     return <div>Loading...</div>;
   }
@@ -78,7 +94,7 @@ function TransactionCategorizer({ onBack, statementData, setStatementData }) {
         <p>Transaction Count: {partner.transaction_count}</p>
         <p>Type: {partner.is_expense ? 'Expense' : 'Income'}</p>
         <p>Most Popular Info: {partner.most_popular_info}</p>
-        <img src={`data:image/png;base64,${partner.price_distribution}`} alt="Price Distribution" />
+        <Histogram histogram={partner.price_distribution} />
       </div>
       <div className="categories">
         <h3>Select a category:</h3>
@@ -111,7 +127,7 @@ function TransactionCategorizer({ onBack, statementData, setStatementData }) {
           </div>
         )}
       </div>
-      <button className="back-button" onClick={onBack}>Back to Insights</button>
+      <button className="back-button" onClick={handleBack}>Back to Insights</button>
     </div>
   );
 }